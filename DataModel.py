@@ -38,10 +38,1302 @@ from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg as FigureCanvas
 
 
 listofsettings=['interpfreq','windowsize','windowshift','ulfmin','ulfmax','vlfmin','vlfmax','lfmin','lfmax','hfmin','hfmax','name']
+listofbandsettings=['ulfmin','ulfmax','vlfmin','vlfmax','lfmin','lfmax','hfmin','hfmax'] # Only change band powers
+FrameBasedKeys=["ULF","VLF","LF","HF","LFHF","Power","Mean HR","HR STD","pNN50","rMSSD","ApEn","FracDim"]
+StorageKeys=["niHR","RR","HR"]+FrameBasedKeys # Stored with the precision of DM.storageType
+
+
+class LazyValue:
+    """Placeholder for a data model entry computed on first access
+        source -> file the value is read from, if any"""
+
+    def __init__(self,loader,source=None):
+        self.loader=loader
+        self.source=source
+
+
+class DataDict(dict):
+    """Dictionary for the data model
+    Entries holding a LazyValue are materialized (and stored) the first time they are read.
+    Every change is stamped with an increasing counter to know what changed since a save"""
+
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.stamp=0
+        self.stamps={}
+
+    def __setitem__(self,key,value):
+        dict.__setitem__(self,key,value)
+        self.SetModified(key)
+
+    def __delitem__(self,key):
+        dict.__delitem__(self,key)
+        self.SetModified(key)
+
+    def __getitem__(self,key):
+        value=dict.__getitem__(self,key)
+        if isinstance(value,LazyValue):
+            value=value.loader()
+            dict.__setitem__(self,key,value)
+        return value
+
+    def get(self,key,default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def pop(self,key,*default):
+        if key in self:
+            value=self[key]
+            del self[key]
+            return value
+        return dict.pop(self,key,*default)
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k,self[k]) for k in self.keys()]
+
+    def IsLoaded(self,key):
+        """Checks if an entry exists and has already been materialized"""
+        return key in self and not isinstance(dict.__getitem__(self,key),LazyValue)
+
+    def Peek(self,key):
+        """Returns the value of an entry, without storing it if it was not materialized"""
+        value=dict.__getitem__(self,key)
+        if isinstance(value,LazyValue):
+            return value.loader()
+        return value
+
+    def MapValue(self,key,function):
+        """Replaces the value of an entry by function(value), lazily if not materialized yet"""
+        value=dict.__getitem__(self,key)
+        if isinstance(value,LazyValue):
+            self[key]=LazyValue(lambda loader=value.loader: function(loader()),value.source)
+        else:
+            self[key]=function(value)
+
+    def GetSource(self,key):
+        """File an entry not materialized yet is read from (None if it is not read from a file)"""
+        value=dict.__getitem__(self,key)
+        if isinstance(value,LazyValue):
+            return value.source
+        return None
+
+    def SetModified(self,key):
+        """Marks an entry as changed (needed when a list or array is modified in place)"""
+        self.stamp+=1
+        self.stamps[key]=self.stamp
+
+    def GetStamp(self):
+        return self.stamp
+
+    def GetModifiedSince(self,stamp):
+        """Returns the entries changed and the entries removed after stamp"""
+        changed=[k for k in self.stamps.keys() if self.stamps[k]>stamp and k in self]
+        removed=[k for k in self.stamps.keys() if self.stamps[k]>stamp and k not in self]
+        return changed,removed
+
+
+def DecodeWFDBBlock(words,samplingFrequency,accumulator=0,skip=0):
+    """Decodes beats positions (seconds) from 16-bit words of a WFDB (MIT format) annotation file
+        words -> array of little-endian uint16 words (np.fromfile(file,dtype='<u2'))
+        accumulator -> time (samples) at the beginning of the block
+        skip -> words at the beginning of the block belonging to a previous payload
+    Every annotation with code<50 is considered a beat
+    Returns beats, accumulator at the end of the block, payload words pending
+    for the next block and whether the end of annotations was found"""
+
+    codes = words >> 10
+    times = words & 1023
+
+    # Pseudo-annotations carrying a payload: SKIP (59, time 0) is followed by two words,
+    # AUX (63) by time bytes (padded to an even number) plus one more word.
+    # Payloads may contain anything, so candidates are walked in order and the ones
+    # falling inside a previous payload are ignored
+    valid = np.ones(len(words),dtype=bool)
+    valid[:skip] = False
+    candidates = np.flatnonzero((words==0) | (words==59*1024) | (codes==63))
+    end = len(words)
+    finished = False
+    skipuntil = skip
+    for pos in candidates:
+        if pos < skipuntil:
+            continue
+        if words[pos]==0:
+            end = pos
+            finished = True
+            break
+        if codes[pos]==59:
+            skipuntil = pos+3
+        else:
+            skipuntil = pos+1+(int(times[pos])+int(times[pos])%2)//2+1
+        valid[pos:skipuntil] = False
+
+    codes = codes[:end]
+    valid = valid[:end]
+
+    # NUM, SUB and CHN (60-62) don't advance time
+    increments = np.where(valid & (codes<60), times[:end], 0).astype(np.int64)
+    increments[:1] += accumulator
+    accumulated = np.cumsum(increments)
+    if len(accumulated)>0:
+        accumulator = int(accumulated[-1])
+
+    return accumulated[valid & (codes<50)]/samplingFrequency, accumulator, max(skipuntil-len(words),0), finished
+
+
+def DecodeWFDBEpisodes(data,samplingFrequency,apneaTag=None):
+    """Decodes episodes from the bytes of a WFDB annotation file
+        apneaTag -> for apnea files, tag of the episodes marked by codes 8 (onset) and 1 (end)
+    Otherwise episodes are the tags of AUX strings (code 22): a tag starts when it appears
+    in a string and ends in the next string without it. Only SKIP (59) advances time.
+    Returns (types, inits, ends, tags still open, onsets of tags still open)"""
+
+    words = np.frombuffer(data,dtype='<u2',count=len(data)//2)
+    codes = words >> 10
+    numWords = len(words)
+
+    # Words taken by each annotation: SKIP carries a 2-word interval, and AUX a length
+    # byte, a 252 byte and the string, padded to whole words
+    jumps = np.ones(numWords,dtype=np.int64)
+    jumps[codes==59] = 3
+    if apneaTag is None:
+        aux = np.flatnonzero(codes==22)
+        lengths = np.append(words,0)[aux+1] & 0xFF
+        jumps[aux] = 2+(lengths+1)//2
+
+    # Only annotations with payload and the terminator need a sequential walk
+    candidates = np.flatnonzero((words==0) | (jumps>1))
+    terminator = None
+    payloads = []
+    nextPosition = 0
+    for position,isZero,jump in zip(candidates.tolist(),(words[candidates]==0).tolist(),jumps[candidates].tolist()):
+        if position < nextPosition:
+            continue # inside the payload of a previous annotation
+        if isZero:
+            terminator = position
+            break
+        payloads.append(position)
+        nextPosition = position+jump
+    if terminator is None:
+        raise ValueError("Annotation file ends without terminator")
+
+    payloads = np.array(payloads,dtype=np.int64)
+    inPayload = np.zeros(terminator+1,dtype=np.int32)
+    inPayload[payloads+1] += 1
+    inPayload[payloads+jumps[payloads]] -= 1
+    visited = np.cumsum(inPayload)[:terminator]==0
+    codes = codes[:terminator]
+
+    skips = payloads[codes[payloads]==59]
+    intervals = words[skips+1].astype(np.int64)*65536+words[skips+2]
+    accumulated = np.concatenate(([0.0],np.cumsum(intervals/samplingFrequency)))
+
+    def TimeAt(positions):
+        return accumulated[np.searchsorted(skips,positions)].tolist()
+
+    EpisodesTypes=[]
+    EpisodesInits=[]
+    EpisodesEnds=[]
+    ActiveTags=[]
+    ActiveTagsOnsets={}
+
+    if apneaTag is not None:
+        # Onsets and ends repeated while the apnea is already open or closed are ignored,
+        # so only the first code of every run counts, starting with an onset
+        events = np.flatnonzero(visited & ((codes==8) | (codes==1)))
+        eventCodes = codes[events]
+        first = np.ones(len(events),dtype=bool)
+        first[1:] = eventCodes[1:]!=eventCodes[:-1]
+        events = events[first]
+        if len(events)>0 and codes[events[0]]==1:
+            events = events[1:]
+        EpisodesInits = TimeAt(events[0::2])
+        EpisodesEnds = TimeAt(events[1::2])
+        EpisodesTypes = [apneaTag]*len(EpisodesEnds)
+        if len(EpisodesInits)>len(EpisodesEnds):
+            ActiveTags.append(apneaTag)
+            ActiveTagsOnsets[apneaTag]=EpisodesInits.pop()
+    else:
+        events = payloads[codes[payloads]==22]
+        for position,accumulator in zip(events.tolist(),TimeAt(events)):
+            ll = ord(data[2*position+2])
+            Tags = data[2*position+4:2*position+4+ll].split()
+            TagsSet = set(Tags)
+
+            # A tag right after a closed one is kept without checking, as
+            # earlier versions of gHRV did
+            StillActive=[]
+            index=0
+            while index < len(ActiveTags):
+                ActiveTag=ActiveTags[index]
+                if ActiveTag in TagsSet:
+                    StillActive.append(ActiveTag)
+                    index += 1
+                else:
+                    EpisodesTypes.append(ActiveTag)
+                    EpisodesInits.append(ActiveTagsOnsets.pop(ActiveTag))
+                    EpisodesEnds.append(accumulator)
+                    StillActive.extend(ActiveTags[index+1:index+2])
+                    index += 2
+            ActiveTags=StillActive
+
+            for Tag in Tags:
+                if Tag not in ActiveTagsOnsets:
+                    ActiveTags.append(Tag)
+                    ActiveTagsOnsets[Tag]=accumulator
+
+    return EpisodesTypes, EpisodesInits, EpisodesEnds, ActiveTags, [ActiveTagsOnsets[Tag] for Tag in ActiveTags]
+
+
+class InterpolatedHR:
+    """Interpolated heart rate computed on demand
+    Time ranges are computed by tiles of the interpolation grid, at full resolution or
+    decimated by a power of two, and the tiles used last are kept in a small cache"""
+
+    TileSamples = 4096
+    CacheTiles = 64
+
+    methodNames = {"linear":"linear interpolation","cubic":"cubic spline","pchip":"monotone cubic interpolation"}
+
+    def __init__(self,BeatTime,niHR,interpfreq,method="linear",dtype=np.float64):
+        import collections
+
+        if method not in self.methodNames:
+            raise ValueError("Unknown interpolation method: "+str(method))
+
+        if method=="linear":
+            def Evaluate(x):
+                return np.interp(x,BeatTime,niHR)
+        elif method=="cubic":
+            from scipy import interpolate
+            Evaluate=interpolate.CubicSpline(BeatTime,niHR)
+        else:
+            slopes=PchipSlopes(BeatTime,niHR)
+            def Evaluate(x):
+                return HermiteInterpolate(x,BeatTime,niHR,slopes)
+
+        self.interpolator=Evaluate
+        self.dtype=dtype
+        self.xmin=BeatTime[0]
+        self.xmax=BeatTime[-1]
+        self.step=1.0/interpfreq
+
+        # Same grid as np.arange(xmin,xmax,step)
+        self.numSamples=max(int(np.ceil((self.xmax-self.xmin)/self.step)),0)
+        self.delta=(self.xmin+self.step)-self.xmin
+
+        self.tiles=collections.OrderedDict()
+
+    def __len__(self):
+        return self.numSamples
+
+    def Evaluate(self,indexes):
+        """Interpolated heart rate at samples of the grid"""
+        grid=np.array(indexes,dtype=np.float64)
+        grid*=self.delta
+        grid+=self.xmin
+        grid[indexes==1]=self.xmin+self.step
+        return np.asarray(self.interpolator(grid),dtype=self.dtype)
+
+    def Materialize(self):
+        """Interpolated heart rate of the whole record
+        The output is allocated once and filled by chunks of the time grid"""
+        HR=np.empty(self.numSamples,dtype=self.dtype)
+        for begin in range(0,self.numSamples,ChunkLength):
+            HR[begin:begin+ChunkLength]=self.Evaluate(np.arange(begin,min(begin+ChunkLength,self.numSamples)))
+        return HR
+
+    def GetRange(self,tmin,tmax,maxPoints=None):
+        """Times and heart rate between tmin and tmax, with at most about maxPoints samples
+        Times are those of the plot of the whole series (samples evenly spread from the
+        first to the last beat)"""
+        if self.numSamples<2:
+            indexes=np.arange(self.numSamples)
+            return np.repeat(self.xmin,self.numSamples),self.Evaluate(indexes)
+
+        plotStep=(self.xmax-self.xmin)/(self.numSamples-1)
+        first=min(max(int(np.floor((tmin-self.xmin)/plotStep)),0),self.numSamples-1)
+        last=min(max(int(np.ceil((tmax-self.xmin)/plotStep)),first),self.numSamples-1)
+
+        stride=1
+        while maxPoints is not None and (last-first)//stride>maxPoints:
+            stride*=2
+        numDecimated=(self.numSamples+stride-1)//stride
+
+        values=[]
+        for tile in range(first//stride//self.TileSamples,last//stride//self.TileSamples+1):
+            key=(stride,tile)
+            if key in self.tiles:
+                tileValues=self.tiles.pop(key)
+            else:
+                begin=tile*self.TileSamples
+                tileValues=self.Evaluate(stride*np.arange(begin,min(begin+self.TileSamples,numDecimated)))
+                if len(self.tiles)>=self.CacheTiles:
+                    self.tiles.popitem(last=False)
+            self.tiles[key]=tileValues
+            values.append(tileValues)
+
+        offset=(first//stride//self.TileSamples)*self.TileSamples
+        decimated=np.arange(first//stride,last//stride+1)
+        yvector=np.concatenate(values)[decimated-offset]
+        indexes=decimated*stride
+        xvector=indexes*plotStep+self.xmin
+        xvector[indexes==self.numSamples-1]=self.xmax
+        return xvector,yvector
+
+
+class WFDBBeatStore:
+    """Beats of a WFDB annotation file, decoded on demand
+    The file is memory-mapped and split in blocks of words. For every block the index keeps
+    its accumulated time, the number of previous beats and the payload words pending from the
+    previous block, so any time range can be decoded without reading the rest of the file.
+    The first and last beats and the shortest and longest intervals between beats are also
+    kept, to set the limits of plots without decoding the whole file"""
+
+    BlockWords = 65536
+
+    def __init__(self,wfdbdatafile,samplingFrequency):
+        self.words = np.memmap(wfdbdatafile,dtype='<u2',mode='r')
+        self.samplingFrequency = samplingFrequency
+        self.beats = None
+        self.firstBeat = None
+        self.lastBeat = None
+        self.minInterval = None
+        self.maxInterval = None
+
+        starts=[]
+        accumulators=[]
+        numbeats=[]
+        skips=[]
+        accumulator=0
+        skip=0
+        count=0
+        finished=False
+        pos=0
+        previous=None
+        minInterval=None
+        maxInterval=None
+        while not finished and pos<len(self.words):
+            starts.append(pos)
+            accumulators.append(accumulator)
+            numbeats.append(count)
+            skips.append(skip)
+            block = np.asarray(self.words[pos:pos+self.BlockWords])
+            beats,accumulator,skip,finished = DecodeWFDBBlock(block,1.0,accumulator,skip)
+            count += len(beats)
+            if len(beats)>0:
+                if previous is not None:
+                    beats = np.insert(beats,0,previous)
+                if len(beats)>1:
+                    intervals = np.diff(beats/samplingFrequency)
+                    minInterval = min(np.min(intervals),minInterval) if minInterval is not None else np.min(intervals)
+                    maxInterval = max(np.max(intervals),maxInterval) if maxInterval is not None else np.max(intervals)
+                if self.firstBeat is None:
+                    self.firstBeat = beats[0]/samplingFrequency
+                self.lastBeat = beats[-1]/samplingFrequency
+                previous = beats[-1]
+            pos += len(block)
+        if not finished:
+            raise ValueError("Truncated WFDB annotation file")
+
+        self.blockStarts = np.array(starts,dtype=np.int64)
+        self.blockAccumulators = np.array(accumulators,dtype=np.int64)
+        self.blockBeats = np.array(numbeats+[count],dtype=np.int64)
+        self.blockSkips = np.array(skips,dtype=np.int64)
+        self.numBeats = count
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+
+    def __len__(self):
+        return self.numBeats
+
+    def __DecodeBlocks(self,first,last):
+        """Decodes beats in blocks first..last (both included)"""
+        end = self.blockStarts[last+1] if last+1<len(self.blockStarts) else len(self.words)
+        beats = DecodeWFDBBlock(np.asarray(self.words[self.blockStarts[first]:end]),self.samplingFrequency,
+            self.blockAccumulators[first],self.blockSkips[first])[0]
+        return beats
+
+    def GetBeats(self,tmin=None,tmax=None,sides=0):
+        """Returns beats positions (seconds) between tmin and tmax (both included)
+            sides -> number of beats also returned at each side of the range, if any
+        Without limits the whole file is decoded once and kept"""
+        if tmin is None and tmax is None:
+            if self.beats is None:
+                self.beats = self.__DecodeBlocks(0,len(self.blockStarts)-1)
+            return self.beats
+        lastblock=len(self.blockStarts)-1
+        if self.beats is not None:
+            beats=self.beats
+        else:
+            # Limits are widened by one sample to be safe against rounding
+            first=0
+            last=lastblock
+            if tmin is not None:
+                first=max(np.searchsorted(self.blockAccumulators,tmin*self.samplingFrequency-1,side='left')-1,0)
+            if tmax is not None:
+                last=max(np.searchsorted(self.blockAccumulators,tmax*self.samplingFrequency+1,side='right')-1,0)
+            # Blocks are added until there are enough beats at the sides
+            while True:
+                beats=self.__DecodeBlocks(first,last)
+                begin=0 if tmin is None else np.searchsorted(beats,tmin,side='left')
+                end=len(beats) if tmax is None else np.searchsorted(beats,tmax,side='right')
+                if begin<sides and first>0:
+                    first-=1
+                elif len(beats)-end<sides and last<lastblock:
+                    last+=1
+                else:
+                    break
+        begin=0 if tmin is None else np.searchsorted(beats,tmin,side='left')
+        end=len(beats) if tmax is None else np.searchsorted(beats,tmax,side='right')
+        return beats[max(begin-sides,0):end+sides]
+
+
+# Byte classes for validating numeric text: 0 not valid, 1 blank, 2 part of a number
+NumericChars = np.zeros(256,dtype=np.uint8)
+NumericChars[np.frombuffer(b' \t\r\n',dtype=np.uint8)] = 1
+NumericChars[np.frombuffer(b'0123456789.eE+-',dtype=np.uint8)] = 2
+
+
+# Number of values processed at once by chunked computations
+ChunkLength = 65536
+
+
+def ReadAsciiColumn(fileName,chunkBytes=1<<20):
+    """Reads a text file with one number per line
+    The file is read in chunks of whole lines. Every chunk is validated and parsed in one
+    call into a buffer that grows geometrically, so the text is never held in memory.
+    Anything else (comments, several values per line, text) raises ValueError,
+    so np.loadtxt can be used instead"""
+
+    values = np.empty(ChunkLength,dtype=np.float64)
+    numvalues = 0
+    pending = b''
+
+    File = open(fileName,'rb')
+    try:
+        while True:
+            data = File.read(chunkBytes)
+            if data:
+                lastline = data.rfind(b'\n')
+                if lastline < 0:
+                    pending += data
+                    continue
+                block = pending+data[:lastline+1]
+                pending = data[lastline+1:]
+            else:
+                block = pending
+
+            # fromstring stops silently at the first non numeric value (and reads
+            # blank text as -1): every token must be numeric, be read as a value
+            # and lie on a different line
+            chars = np.frombuffer(block,dtype=np.uint8)
+            classes = NumericChars[chars]
+            if np.count_nonzero(classes==0)>0:
+                raise ValueError("Non numeric data in "+fileName)
+            blank = classes==1
+            tokenstarts = ~blank
+            tokenstarts[1:] &= blank[:-1]
+            tokenlines = np.cumsum(chars==10,dtype=np.int32)[tokenstarts]
+            if len(tokenlines)==0:
+                chunk = np.empty(0)
+            else:
+                chunk = np.fromstring(block,dtype=np.float64,sep=' ')
+            if len(tokenlines) != len(chunk):
+                raise ValueError("Non numeric data in "+fileName)
+            if np.count_nonzero(np.diff(tokenlines)==0)>0:
+                raise ValueError("More than one value per line in "+fileName)
+
+            if numvalues+len(chunk) > len(values):
+                values.resize(max(2*len(values),numvalues+len(chunk)),refcheck=False)
+            values[numvalues:numvalues+len(chunk)] = chunk
+            numvalues += len(chunk)
+
+            if not data:
+                break
+    finally:
+        File.close()
+
+    if numvalues==0:
+        raise ValueError("No data in "+fileName)
+    values.resize(numvalues,refcheck=False)
+
+    return values
+
+
+def ReadSectionColumn(fileName,section,column=0):
+    """Reads numeric data from the sections of an ini-like file (Polar .hrm, Suunto .sdf)
+        section -> name of the section, without brackets ("HRData", "CUSTOM1", ...)
+        column -> column to return when rows have more than one value
+    Every block is parsed in one call. If the section appears several times,
+    data from all of them are concatenated"""
+
+    import re
+
+    File = open(fileName,'rb')
+    text = File.read()
+    File.close()
+
+    header = re.compile(br'^[ \t]*\['+re.escape(section.encode('ascii'))+br'\][ \t]*\r?$',re.M)
+    nextheader = re.compile(br'^[ \t]*\[',re.M)
+    firstline = re.compile(br'\S[^\r\n]*')
+
+    columns=[]
+    for match in header.finditer(text):
+        found = nextheader.search(text,match.end())
+        end = found.start() if found else len(text)
+        block = text[match.end():end]
+
+        # fromstring stops silently at the first non numeric value (and reads blank
+        # text as -1), so the block must only contain numeric characters and
+        # as many tokens as values read
+        chars = np.frombuffer(block,dtype=np.uint8)
+        classes = NumericChars[chars]
+        blank = classes==1
+        numtokens = np.count_nonzero(blank[:-1] & ~blank[1:]) + int(len(blank)>0 and not blank[0])
+        if numtokens==0:
+            continue
+        values = np.fromstring(block,dtype=np.float64,sep=' ')
+        if numtokens != len(values) or np.count_nonzero(classes==0)>0:
+            raise ValueError("Non numeric data in section ["+section+"] of "+fileName)
+
+        numcolumns = len(firstline.search(block).group().split())
+        if len(values)%numcolumns != 0:
+            raise ValueError("Rows with different number of columns in section ["+section+"] of "+fileName)
+        columns.append(values.reshape(-1,numcolumns)[:,column])
+
+    if len(columns)==0:
+        raise ValueError("No data in section ["+section+"] of "+fileName)
+
+    return np.concatenate(columns)
+
+
+def MapZipArray(zipFileName,zf,member):
+    """Memory-maps (copy-on-write) a .npy member stored without compression in a zip file
+    Returns None when the member can't be mapped (compressed, empty...)"""
+
+    import struct, zipfile
+
+    info = zf.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED or info.file_size == 0:
+        return None
+
+    File = open(zipFileName,'rb')
+    try:
+        # Local file header: 30 bytes, then file name and extra field
+        File.seek(info.header_offset)
+        localheader = File.read(30)
+        namelength,extralength = struct.unpack('<HH',localheader[26:30])
+        File.seek(info.header_offset+30+namelength+extralength)
+        version = np.lib.format.read_magic(File)
+        if version == (1,0):
+            shape,fortran,dtype = np.lib.format.read_array_header_1_0(File)
+        else:
+            shape,fortran,dtype = np.lib.format.read_array_header_2_0(File)
+        offset = File.tell()
+    finally:
+        File.close()
+
+    if dtype.hasobject or np.prod(shape) == 0:
+        return None
+
+    return np.memmap(zipFileName,dtype=dtype,mode='c',offset=offset,shape=shape,order='F' if fortran else 'C')
+
+
+def WriteProjectMembers(zipFileName,members,removed=[],mode='w'):
+    """Writes (member name, data, compression) tuples into a project file
+    In append mode ('a') members are added after the existing ones, so they supersede
+    members with the same name, and removed entries are written as "-" members"""
+
+    import zipfile, warnings
+
+    zf = zipfile.ZipFile(zipFileName, mode=mode, compression=zipfile.ZIP_DEFLATED)
+    with warnings.catch_warnings():
+        # Superseded members are expected when appending
+        warnings.simplefilter("ignore")
+        for member,data,compression in members:
+            zf.writestr(member,data,compression)
+        for kData in removed:
+            zf.writestr("-"+str(kData),"")
+    zf.close()
+
+
+def CopyProjectMember(zipFileName,dataName):
+    """Member of an array entry as stored in a project file, as a (member name, data,
+    compression) tuple; the array is not decoded"""
+
+    import zipfile
+
+    zf = zipfile.ZipFile(zipFileName, mode='r')
+    try:
+        member="#"+str(dataName)+".npy"
+        if member not in zf.namelist():
+            member="#"+str(dataName) # Arrays as text (project format 1)
+        # With superseded members, the last one is read
+        info=zf.getinfo(member)
+        return (member,zf.read(member),info.compress_type)
+    finally:
+        zf.close()
+
+
+def ProjectWastedBytes(zipFileName):
+    """Returns bytes taken by superseded or removed members of a project file, and by live members"""
+
+    import zipfile
+
+    live={}
+    wasted=0
+    zf = zipfile.ZipFile(zipFileName, mode='r')
+    for zfinfo in zf.infolist():
+        dataName=zfinfo.filename[1:]
+        if dataName.endswith(".npy"):
+            dataName=dataName[:-4]
+        wasted += live.get(dataName,0)
+        if zfinfo.filename[0]=="-":
+            live[dataName]=0
+            wasted += zfinfo.compress_size
+        else:
+            live[dataName]=zfinfo.compress_size
+    zf.close()
+
+    return wasted,sum(live.values())
+
+
+def ReadZipArray(zipFileName,member,memoryMap=False):
+    """Reads an array member (.npy or text) from a project file"""
+
+    import zipfile, io
+
+    zf = zipfile.ZipFile(zipFileName, mode='r')
+    try:
+        if member.endswith(".npy"):
+            array=None
+            if memoryMap:
+                array=MapZipArray(zipFileName,zf,member)
+            if array is None:
+                array=np.load(io.BytesIO(zf.read(member)))
+        else:
+            array=np.loadtxt(io.BytesIO(zf.read(member)))
+    finally:
+        zf.close()
+
+    return array
+
+
+def LoadRecordData(fileName,settings):
+    """Loads a beats file of any supported format, chosen by its extension
+    Returns (data, error): the entries of the data model, or the error message if
+    loading failed. Entries are plain values, so they can be sent between processes"""
+    try:
+        record=DM(False)
+        extension=os.path.splitext(fileName)[1][1:].strip().lower()
+        if extension=="hrm":
+            record.LoadFilePolar(fileName,settings)
+        elif extension=="sdf":
+            record.LoadFileSuunto(fileName,settings)
+        elif extension=="hea":
+            record.LoadBeatWFDB(fileName,settings,interactive=False)
+        else:
+            record.LoadFileAscii(fileName,settings)
+        if not record.HasHR():
+            raise ValueError("No beats found")
+        return dict(record.data.items()),None
+    except Exception as error:
+        return None,error.__class__.__name__+": "+str(error)
+
+
+def LoadRecords(fileNames,settings,workers=None,useProcesses=True):
+    """Loads several beats files concurrently, one data model per file
+        fileNames -> ascii, polar, suunto or wfdb header files
+        workers -> size of the pool (number of cpus by default)
+        useProcesses -> pool of processes; if False, threads of this process
+    Returns (records, errors): data models in the order of fileNames (None for
+    files that failed to load) and a dictionary with the error of every failed file"""
+    import multiprocessing, multiprocessing.pool
+
+    if len(fileNames)==0:
+        return [],{}
+
+    if workers is None:
+        workers=multiprocessing.cpu_count()
+    workers=max(1,min(workers,len(fileNames)))
+    if useProcesses:
+        pool=multiprocessing.Pool(workers)
+    else:
+        pool=multiprocessing.pool.ThreadPool(workers)
+    try:
+        results=[pool.apply_async(LoadRecordData,(fileName,settings)) for fileName in fileNames]
+        results=[result.get() for result in results]
+    finally:
+        pool.close()
+        pool.join()
+
+    records=[]
+    errors={}
+    for fileName,(data,error) in zip(fileNames,results):
+        if error is not None:
+            records.append(None)
+            errors[fileName]=error
+        else:
+            record=DM(False)
+            for k in data.keys():
+                record.data[k]=data[k]
+            records.append(record)
+
+    return records,errors
+
+
+frameWorkerData={} # Beat times and data model of every process of FrameNonLinearAnalysis
+
+
+def InitFrameWorker(sharedBeatTime):
+    """Initializer of the processes of FrameNonLinearAnalysis: maps the shared beat times"""
+    frameWorkerData["BeatTime"]=np.frombuffer(sharedBeatTime,dtype=np.float64)
+    frameWorkerData["model"]=DM(False)
+
+
+def NonLinearFrames(model,BeatTime,first,last):
+    """ApEn and FracDim of the frames with beats BeatTime[first[i]:last[i]]"""
+    return [model.CalculateNonLinearAnalysis(BeatTime[begin:end]) for begin,end in zip(first,last)]
+
+
+def NonLinearFramesTask(task):
+    """NonLinearFrames of a chunk of frames (first,last) in a process of FrameNonLinearAnalysis"""
+    first,last=task
+    return NonLinearFrames(frameWorkerData["model"],frameWorkerData["BeatTime"],first,last)
+
+
+def FrameNonLinearAnalysis(BeatTime,first,last,workers=1,progress=None,chunkFrames=10):
+    """ApEn and FracDim of every frame, whose beats are BeatTime[first[i]:last[i]]
+        workers -> processes sharing the frames (number of cpus if 0); beat times
+            are passed to them in shared memory
+        progress -> called as progress(done,total) after every chunk of frames;
+            the analysis is cancelled if it returns False
+    Returns arrays (ApEn, FracDim) in frame order, or None if cancelled"""
+    import multiprocessing, multiprocessing.sharedctypes
+
+    numframes=len(first)
+    chunks=[(first[begin:begin+chunkFrames],last[begin:begin+chunkFrames]) for begin in range(0,numframes,chunkFrames)]
+
+    if workers==0:
+        workers=multiprocessing.cpu_count()
+    workers=max(1,min(workers,len(chunks)))
+    if workers>1:
+        sharedBeatTime=multiprocessing.sharedctypes.RawArray('d',len(BeatTime))
+        np.frombuffer(sharedBeatTime,dtype=np.float64)[:]=BeatTime
+        pool=multiprocessing.Pool(workers,InitFrameWorker,(sharedBeatTime,))
+        results=pool.imap(NonLinearFramesTask,chunks)
+    else:
+        pool=None
+        model=DM(False)
+        results=(NonLinearFrames(model,BeatTime,chunkFirst,chunkLast) for chunkFirst,chunkLast in chunks)
+
+    values=[]
+    try:
+        for result in results:
+            values.extend(result)
+            if progress is not None and not progress(len(values),numframes):
+                return None
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    values=np.array(values,dtype=np.float64).reshape(-1,2)
+    return values[:,0],values[:,1]
+
+
+class RingBuffer:
+    """Values of a series arriving in order, of which only the last ones are kept
+    Values are addressed by their index in the whole series; discarded values leave
+    room for new ones, so the storage only grows if more values are kept at once"""
+
+    def __init__(self,capacity=1024,dtype=np.float64):
+        self.values=np.empty(capacity,dtype=dtype)
+        self.offset=0 # Position of the first value kept in values
+        self.first=0 # Index in the series of the first value kept
+        self.length=0
+
+    def __len__(self):
+        """Number of values of the whole series"""
+        return self.first+self.length
+
+    def Append(self,values):
+        values=np.atleast_1d(values)
+        if self.offset+self.length+len(values)>len(self.values):
+            capacity=len(self.values)
+            while self.length+len(values)>capacity:
+                capacity*=2
+            kept=self.values[self.offset:self.offset+self.length]
+            if capacity!=len(self.values):
+                self.values=np.empty(capacity,dtype=self.values.dtype)
+            self.values[:self.length]=kept
+            self.offset=0
+        end=self.offset+self.length
+        self.values[end:end+len(values)]=values
+        self.length+=len(values)
+
+    def Discard(self,end):
+        """Discards values of the series before index end"""
+        count=min(max(end-self.first,0),self.length)
+        self.offset+=count
+        self.first+=count
+        self.length-=count
+
+    def Get(self,begin,end):
+        """Values of the series from index begin to end (only the ones kept)"""
+        begin=max(begin,self.first)-self.first+self.offset
+        end=min(end,len(self))-self.first+self.offset
+        return self.values[begin:max(begin,end)]
+
+
+class OnlineFrameAnalysis:
+    """Frame-based analysis of beats arriving live
+    Beats are appended to ring buffers and the interpolated heart rate (linear) is extended
+    with the samples between the last beats. The parameters of every frame are computed
+    once, when its heart rate samples and its beats are complete, with work proportional
+    to the frame. Frames and parameters are those of DM.CalculateFrameBasedParams with the
+    same settings and beats"""
+
+    def __init__(self,settings,callback=None):
+        """settings -> frame-based settings, as in factorySettings
+        callback -> called as callback(index,params) for every new frame"""
+        self.settings={}
+        for k in settings.keys():
+            if k!='name':
+                self.settings[k]=float(settings[k])
+        self.callback=callback
+
+        self.step=1.0/self.settings["interpfreq"]
+        self.shiftsamp=self.settings['windowshift']*self.settings["interpfreq"]
+        self.sizesamp=self.settings['windowsize']*self.settings["interpfreq"]
+        sizesamp2=self.sizesamp
+        if (sizesamp2%2 != 0):
+            sizesamp2=sizesamp2+1
+        self.hw=np.hamming(sizesamp2)
+        self.fftLength=FFTLength(self.sizesamp,frameFFTFastLength)
+
+        self.beats=RingBuffer()
+        self.niHR=RingBuffer()
+        self.HR=RingBuffer()
+        self.numFrames=0
+        self.model=DM(False)
+
+    def AddBeats(self,times):
+        """Appends beats (times in seconds, in order)
+        Returns the list of (index, params) of the frames completed by these beats"""
+        frames=[]
+        for time in np.atleast_1d(np.asarray(times,dtype=np.float64)):
+            self.__AddBeat(time)
+            while self.__FrameComplete(self.numFrames):
+                params=self.__FrameParams(self.numFrames)
+                frames.append((self.numFrames,params))
+                if self.callback is not None:
+                    self.callback(self.numFrames,params)
+                self.numFrames+=1
+                self.__DiscardBefore(self.numFrames)
+        return frames
+
+    def __AddBeat(self,time):
+        numBeats=len(self.beats)
+        self.beats.Append(time)
+        if numBeats==0:
+            self.start=time
+            self.delta=(time+self.step)-time # Same grid as InterpolatedHR
+            return
+        last=self.beats.Get(numBeats-1,numBeats+1)
+        niHR=60.0/(last[1]-last[0])
+        if numBeats==1:
+            self.niHR.Append([niHR,niHR]) # niHR[0]=niHR[1]
+        else:
+            self.niHR.Append(niHR)
+
+        # New samples lie between the last two beats
+        first=len(self.HR)
+        end=max(int(np.ceil((time-self.start)/self.step)),0)
+        if end>first:
+            indexes=np.arange(first,end)
+            grid=indexes*self.delta+self.start
+            grid[indexes==1]=self.start+self.step
+            self.HR.Append(np.interp(grid,self.beats.Get(numBeats-2,numBeats+1),self.niHR.Get(numBeats-2,numBeats+1)))
+
+    def __FrameBounds(self,index):
+        """First HR sample and beat times of a frame"""
+        begframe=int(index*self.shiftsamp)
+        begtime=index*self.settings['windowshift']
+        return begframe,begtime,begtime+self.settings['windowsize']
+
+    def __FrameComplete(self,index):
+        begframe,begtime,endtime=self.__FrameBounds(index)
+        numSamples=len(self.HR)
+        if numSamples<self.sizesamp or int(((numSamples-self.sizesamp)/self.shiftsamp)+1.0)<=index:
+            return False
+        return len(self.beats)>0 and self.beats.Get(len(self.beats)-1,len(self.beats))[0]>endtime
+
+    def __FrameParams(self,index):
+        begframe,begtime,endtime=self.__FrameBounds(index)
+        HR=self.HR.Get(begframe,int(begframe+self.sizesamp))
+        signal=1000/(HR/60.0) # msec.
+        spectra=FrameSpectra(signal,[0],len(signal),self.fftLength,self.hw)
+        params={}
+        for k,value in FrameBandPowers(spectra,self.settings).items():
+            params[k]=value[0]
+
+        beats=self.beats.Get(0,len(self.beats))
+        BeatsFrame=beats[np.searchsorted(beats,begtime,side='left'):np.searchsorted(beats,endtime,side='right')]
+        RRDiffs=np.diff(1000.0*np.diff(BeatsFrame))
+        params["Mean HR"]=np.mean(HR)
+        params["HR STD"]=np.std(HR,ddof=1)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            params["pNN50"]=100.0*np.sum(np.abs(RRDiffs)>50)/np.float64(len(RRDiffs))
+            params["rMSSD"]=np.sqrt(np.sum(RRDiffs**2)/np.float64(len(RRDiffs)))
+        params["ApEn"],params["FracDim"]=self.model.CalculateNonLinearAnalysis(BeatsFrame)
+        return params
+
+    def __DiscardBefore(self,index):
+        """Discards samples and beats not used by frames from index on (the last
+        beats are kept to interpolate the next samples)"""
+        begframe,begtime,endtime=self.__FrameBounds(index)
+        self.HR.Discard(begframe)
+        beats=self.beats.Get(0,len(self.beats))
+        end=min(self.beats.first+np.searchsorted(beats,begtime,side='left'),len(self.beats)-3)
+        self.beats.Discard(end)
+        self.niHR.Discard(end)
+
+
+class FrameProgressDialog:
+    """Progress callback of the frame-based analysis that shows a wx.ProgressDialog
+    (only for more than 10 frames); it returns False if the user cancels"""
+
+    def __init__(self,title="Calculating parameters"):
+        self.title=title
+        self.dlg=None
+
+    def __call__(self,done,total):
+        if total<=10:
+            return True
+        if self.dlg is None:
+            import wx
+            self.dlg = wx.ProgressDialog(self.title,"Preparing data...",maximum = total,
+                style=wx.PD_CAN_ABORT | wx.PD_AUTO_HIDE | wx.PD_REMAINING_TIME | wx.PD_ESTIMATED_TIME)
+        return self.dlg.Update(done, "Frame number: %s/%s" % (done,total))[0]
+
+    def Destroy(self):
+        if self.dlg is not None:
+            self.dlg.Destroy()
+            self.dlg=None
+
+
+def HeuristicFilterMask(niHR,winlength=50,last=13,minbpm=24,maxbpm=198):
+    """Beats accepted by the filter of gHRV (True for accepted beats)
+    Beats are checked in order: a beat is accepted if it is in range and close to the
+    previous accepted beat, to the next beat or to the mean of the last accepted beats"""
+
+    import bisect
+
+    # threshold initialization
+    ulast=last
+    umean=1.5*ulast
+
+    numBeats=len(niHR)
+    keep=np.ones(numBeats,dtype=bool)
+
+    if numBeats>2:
+        # Beats are only removed at the current position, so the next beat is always
+        # the original one and, while no beat is rejected, the previous one too
+        inRange=(niHR > minbpm) & (niHR < maxbpm)
+        okNext=np.zeros(numBeats,dtype=bool)
+        okNext[:-1]=100*abs((niHR[:-1]-niHR[1:])/niHR[1:]) < ulast
+        okPrev=np.zeros(numBeats,dtype=bool)
+        okPrev[1:]=100*abs((niHR[1:]-niHR[:-1])/niHR[:-1]) < ulast
+
+        rejected=[]
+
+        def WindowMean(index):
+            """Mean of the last winlength accepted beats before index"""
+            begin=max(index-winlength,0)
+            while begin>0:
+                numRejected=len(rejected)-bisect.bisect_left(rejected,begin)
+                missing=winlength-(index-begin-numRejected)
+                if missing<=0:
+                    break
+                begin=max(begin-missing,0)
+            window=niHR[begin:index]
+            return np.mean(window[keep[begin:index]],dtype=np.float64)
+
+        def Accepted(index,previous):
+            if not inRange[index]:
+                return False
+            if okNext[index]:
+                return True
+            if previous==index-1:
+                if okPrev[index]:
+                    return True
+            elif 100*abs((niHR[index]-niHR[previous])/niHR[previous]) < ulast:
+                return True
+            M=WindowMean(index)
+            return 100*abs((niHR[index]-M)/M) < umean
+
+        # Only beats not accepted by the vectorized tests, and those after a
+        # rejected beat, are checked in order
+        candidates=(np.flatnonzero(~(inRange & (okNext | okPrev))[1:-1])+1).tolist()
+        candidates.append(numBeats-1)
+        position=0
+        index=candidates[0]
+        previous=index-1
+        while index<numBeats-1:
+            if index==candidates[position]:
+                position+=1
+            if Accepted(index,previous):
+                index=candidates[position]
+                previous=index-1
+            else:
+                keep[index]=False
+                rejected.append(index)
+                index+=1
+
+    return keep
+
+
+def PchipSlopes(x,y):
+    """Slopes of the monotone cubic (PCHIP, Fritsch-Carlson) interpolation of y(x)
+    Same slopes as scipy's PchipInterpolator, computed for all points at once"""
+    h=np.diff(x)
+    m=np.diff(y)/h
+    if len(x)==2:
+        return np.array([m[0],m[0]])
+
+    slopes=np.zeros(len(x))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        w1=2*h[1:]+h[:-1]
+        w2=h[1:]+2*h[:-1]
+        whmean=(w1/m[:-1]+w2/m[1:])/(w1+w2)
+        inner=1.0/whmean
+    flat=(np.sign(m[1:])!=np.sign(m[:-1])) | (m[1:]==0) | (m[:-1]==0)
+    slopes[1:-1]=np.where(flat,0.0,inner)
+
+    def EdgeSlope(h0,h1,m0,m1):
+        d=((2*h0+h1)*m0-h0*m1)/(h0+h1)
+        if np.sign(d)!=np.sign(m0):
+            return 0.0
+        if np.sign(m0)!=np.sign(m1) and abs(d)>3.0*abs(m0):
+            return 3.0*m0
+        return d
+
+    slopes[0]=EdgeSlope(h[0],h[1],m[0],m[1])
+    slopes[-1]=EdgeSlope(h[-1],h[-2],m[-1],m[-2])
+    return slopes
+
+
+def HermiteInterpolate(grid,x,y,slopes):
+    """Evaluates at grid (inside x[0]..x[-1]) the cubic Hermite interpolation of y(x)"""
+    j=np.clip(np.searchsorted(x,grid,side='right')-1,0,len(x)-2)
+    h=x[j+1]-x[j]
+    t=(grid-x[j])/h
+    t2=t*t
+    t3=t2*t
+    return ((2*t3-3*t2+1)*y[j]+(t3-2*t2+t)*h*slopes[j]
+        +(3*t2-2*t3)*y[j+1]+(t3-t2)*h*slopes[j+1])
+
+
+def SlidingWindows(values,winlength):
+    """Read-only view of all the windows of winlength consecutive values, one per row"""
+    from numpy.lib.stride_tricks import as_strided
+    numWindows=max(len(values)-winlength+1,0)
+    return as_strided(values,shape=(numWindows,winlength),strides=(values.strides[0],values.strides[0]),writeable=False)
+
+
+def RollingMedian(values,winlength):
+    """Median of the winlength values centered on every value
+    The first and last values are repeated to fill the windows at the edges"""
+    values=np.ascontiguousarray(values,dtype=np.float64)
+    half=winlength//2
+    padded=np.pad(values,(half,winlength-1-half),mode='edge')
+    medians=np.empty(len(values))
+    for begin in range(0,len(values),ChunkLength):
+        windows=SlidingWindows(padded[begin:begin+ChunkLength+winlength-1],winlength)
+        medians[begin:begin+len(windows)]=np.median(windows,axis=1)
+    return medians
+
+
+def WindowSums(values,begin,end):
+    """Sums of values[begin[i]:end[i]] for every window i, as differences of the
+    cumulative sums, so the cost does not depend on the overlap of the windows"""
+    sums=np.concatenate(([0.0],np.cumsum(values,dtype=np.float64)))
+    return sums[end]-sums[begin]
+
+
+def PreviousMean(values,winlength):
+    """Mean of the winlength values before every value (fewer at the beginning)
+    The first value has no previous values, and its own value is used"""
+    sums=np.concatenate(([0.0],np.cumsum(values,dtype=np.float64)))
+    index=np.arange(len(values))
+    begin=np.maximum(index-winlength,0)
+    means=(sums[index]-sums[begin])/np.maximum(index-begin,1)
+    means[:1]=values[:1]
+    return means
+
+
+def FrameSpectra(signal,starts,frameLength,fftLength,window,chunkFrames=None):
+    """Power spectra (positive half) of the frames of signal, one per row
+        starts -> first sample of every frame
+        frameLength -> samples per frame, a zero is appended if it is odd
+        fftLength -> frames are zero-padded to this length
+        window -> applied to every frame after removing its mean
+        chunkFrames -> frames transformed at once, bounds temporary memory
+    Frames are taken from a strided view of signal when they are evenly spaced"""
+    from numpy.lib.stride_tricks import as_strided
+    signal=np.ascontiguousarray(signal,dtype=np.float64)
+    starts=np.asarray(starts,dtype=np.int64)
+    numframes=len(starts)
+    numbins=fftLength//2
+    if chunkFrames is None:
+        chunkFrames=max(1,16*ChunkLength//fftLength)
+    shifts=np.diff(starts)
+    evenlySpaced=numframes<2 or np.all(shifts==shifts[0])
+    if evenlySpaced and numframes>0:
+        step=shifts[0] if numframes>1 else 1
+        frames=as_strided(signal[starts[0]:],shape=(numframes,frameLength),
+            strides=(step*signal.strides[0],signal.strides[0]),writeable=False)
+    spectra=np.empty((numframes,numbins))
+    block=np.empty((min(chunkFrames,numframes),frameLength+frameLength%2))
+    for begin in range(0,numframes,chunkFrames):
+        end=min(begin+chunkFrames,numframes)
+        chunk=block[:end-begin]
+        chunk[:,frameLength:]=0 # Reset the zero appended to odd frames
+        if evenlySpaced:
+            chunk[:,:frameLength]=frames[begin:end]
+        else:
+            chunk[:,:frameLength]=signal[starts[begin:end,None]+np.arange(frameLength)]
+        chunk-=np.mean(chunk,axis=1)[:,None]
+        chunk*=window
+        spectrum=np.fft.rfft(chunk,n=fftLength,axis=1)[:,:numbins]
+        spectra[begin:end]=spectrum.real**2+spectrum.imag**2
+    return spectra
+
+
+def BandBins(numbins,interpfreq,bands):
+    """Bin ranges of the bands (fmin,fmax) in spectra of numbins bins spread over
+    0..interpfreq/2; band i holds bins first[i]<=bin<last[i], that is fmin<=f<fmax"""
+    freqs=np.linspace(start=0,stop=interpfreq/2,num=numbins,endpoint=True)
+    bands=np.asarray(bands,dtype=np.float64).reshape(-1,2)
+    first=np.searchsorted(freqs,bands[:,0],side='left')
+    last=np.maximum(np.searchsorted(freqs,bands[:,1],side='left'),first)
+    return first,last
+
+
+def BandSums(spectra,first,last):
+    """Sum of the bins of every band (columns) for every spectrum (rows), as
+    differences of the cumulative spectra"""
+    cumulative=np.zeros((len(spectra),spectra.shape[1]+1))
+    np.cumsum(spectra,axis=1,out=cumulative[:,1:])
+    return cumulative[:,last]-cumulative[:,first]
+
+
+def FrameBandPowers(spectra,settings):
+    """Power of every frame in every band (and LF/HF) from the spectra of the frames
+    Returns a dictionary of arrays, with band limits taken from settings
+    Powers are normalized to the power of 2 FFT length of the frames, so padding
+    them to a fast FFT length doesn't rescale the powers"""
+    hammingfactor=1.586
+
+    bandKeys=["ULF","VLF","LF","HF","Power"]
+    bands=[(settings["ulfmin"],settings["ulfmax"]),(settings["vlfmin"],settings["vlfmax"]),
+        (settings["lfmin"],settings["lfmax"]),(settings["hfmin"],settings["hfmax"]),
+        (0,settings["interpfreq"]/2.0)]
+
+    numbins=spectra.shape[1]
+    refbins=FFTLength(settings["windowsize"]*settings["interpfreq"])//2
+    first,last=BandBins(numbins,settings["interpfreq"],bands)
+    sums=BandSums(spectra,first,last)
+    powers={}
+    for index,k in enumerate(bandKeys):
+        powers[k]=hammingfactor*sums[:,index]/(2*numbins*refbins)
+    powers["LFHF"]=powers["LF"]/powers["HF"]
+    return powers
+
+
+def FFTLength(sizesamp,fastLength=False):
+    """Length of the FFT of frames of sizesamp samples: next power of 2, or
+    the next length that FFTPACK transforms fast if fastLength"""
+    if fastLength:
+        from scipy.fftpack import next_fast_len
+        return next_fast_len(int(sizesamp)+int(sizesamp)%2)
+    return 2**int(np.ceil(np.log2(sizesamp)))+int(sizesamp)%2
+
+
+class HeuristicFilter:
+    """Filter stage with the heuristic of gHRV, see HeuristicFilterMask"""
+
+    name="Heuristic"
+
+    def __init__(self,winlength=50,last=13,minbpm=24,maxbpm=198):
+        self.winlength=winlength
+        self.last=last
+        self.minbpm=minbpm
+        self.maxbpm=maxbpm
+
+    def Mask(self,niHR):
+        return HeuristicFilterMask(niHR,self.winlength,self.last,self.minbpm,self.maxbpm)
+
+
+class RangeFilter:
+    """Filter stage rejecting beats out of physiological limits (bpm)"""
+
+    name="Range"
+
+    def __init__(self,minbpm=24,maxbpm=198):
+        self.minbpm=minbpm
+        self.maxbpm=maxbpm
+
+    def Mask(self,niHR):
+        return (niHR > self.minbpm) & (niHR < self.maxbpm)
+
+
+class PercentageChangeFilter:
+    """Filter stage rejecting beats that differ more than maxchange (%)
+    from the mean of the winlength previous beats"""
+
+    name="Percentage change"
+
+    def __init__(self,winlength=5,maxchange=20):
+        self.winlength=winlength
+        self.maxchange=maxchange
+
+    def Mask(self,niHR):
+        reference=PreviousMean(niHR,self.winlength)
+        return 100*np.abs(niHR-reference) <= self.maxchange*reference
+
+
+class MedianFilter:
+    """Filter stage rejecting beats that differ more than maxdeviation (%)
+    from the median of the winlength beats around them"""
+
+    name="Median"
+
+    def __init__(self,winlength=11,maxdeviation=20):
+        self.winlength=winlength
+        self.maxdeviation=maxdeviation
+
+    def Mask(self,niHR):
+        reference=RollingMedian(niHR,self.winlength)
+        return 100*np.abs(niHR-reference) <= self.maxdeviation*reference
+
 
 class DM:
         
-    data={}
+    data=DataDict()
+    beatStore=None
+    hrView=None
+    spectraCache=None
+    keepSpectrogram=frameSpectrogram
+    storageType=np.dtype(storagePrecision)
+    savedStamps={}
+    autosavePending={}
+    autosaveThread=None
     labelColors=['Orange','cyan','red','blue','green','yellow','grey','pink','purple','maroon','lightgreen']
 
     def __init__(self,Verbose):
@@ -55,10 +1347,35 @@ class DM:
 
     def SetVerbose(self,verboseValue):
         self.data["Verbose"] = verboseValue
+
+    def SetStoragePrecision(self,precision):
+        """Sets the precision of heart rate arrays (niHR, RR, HR) and frame-based results
+            precision -> "float64" or "float32" (half the memory; calculations are still
+                         done in float64)
+        BeatTime is always float64, so long recordings keep their time resolution.
+        Arrays already in the data model are converted"""
+        if precision not in ("float64","float32"):
+            raise ValueError("Unknown storage precision: "+str(precision))
+        self.storageType=np.dtype(precision)
+
+        storageType=self.storageType
+        for k in StorageKeys:
+            if k in self.data:
+                self.data.MapValue(k,lambda value: np.asarray(value,dtype=storageType))
+        if self.hrView is not None:
+            self.hrView.dtype=storageType
+
+        if self.data["Verbose"]:
+            print("** Storage precision: "+precision)
         
             
     def ClearAll(self):
-        self.data={}
+        self.data=DataDict()
+        self.beatStore=None
+        self.hrView=None
+        self.spectraCache=None
+        self.savedStamps={}
+        self.autosavePending={}
         self.data["Verbose"]=Verbose
         
         self.data["name"]=""
@@ -79,6 +1396,7 @@ class DM:
         self.data["Bands"]=["LF/HF","ULF","VLF","LF","HF","Power","Mean HR","HR STD","pNN50","rMSSD","ApEn","FracDim","Heart rate"]
         self.data["VisibleBands"]=["LF/HF","ULF","VLF","LF","HF","Heart rate"]
         self.data["FixedBands"]=["Heart rate"]
+        self.data["SpectrogramVisible"]=False
 
     def ClearPP(self):
         self.data["PPActiveTagLeft"]="Global"
@@ -92,6 +1410,7 @@ class DM:
         else:
             self.data["DictColors"][Tag]=self.labelColors[self.data["ColorIndex"]]
             self.data["ColorIndex"] += 1
+        self.data.SetModified("DictColors")
                     
     def GetEpisodeColor(self,Tag):
         """Returns color assigned to an episode Tag"""
@@ -102,24 +1421,37 @@ class DM:
         One data (beats instants in seconds, rr in msec. or rr in sec.) per line"""
         
         
+        def anyDecreasing(values,chunk=ChunkLength):
+            for start in range(0,len(values)-1,chunk):
+                if np.count_nonzero(np.diff(values[start:start+chunk+1])<0)>0:
+                    return True
+            return False
+
+        def anyGreater(values,threshold,chunk=ChunkLength):
+            for start in range(0,len(values),chunk):
+                if np.count_nonzero(values[start:start+chunk]>threshold)>0:
+                    return True
+            return False
+        
         if (self.data["Verbose"]==True):
             print("** Loading ascii file "+asciiFile)
                 
-                
-        asciiData = np.loadtxt(asciiFile)
-        asciiDataDiffs=np.diff(asciiData)
-        asciiDataNeg = [ x for x in asciiDataDiffs if x<0]
+        try:
+            asciiData = ReadAsciiColumn(asciiFile)
+        except ValueError:
+            # Comments, several columns...
+            asciiData = np.loadtxt(asciiFile)
         
-        if len(asciiDataNeg)>0:  # The file contains an RR series
-            asciiDataBig = [x for x in asciiData if x>100]
-            if len(asciiDataBig)>0:
+        if anyDecreasing(asciiData):  # The file contains an RR series
+            if anyGreater(asciiData,100):
                 if (self.data["Verbose"]==True):
                     print("   File contains RR data in milliseconds")
                 self.LoadRRMillisec(asciiData,settings)
             else:
                 if (self.data["Verbose"]==True):
                     print("   File contains RR data in seconds")
-                self.LoadRRMillisec(asciiData*1000.0,settings)
+                asciiData *= 1000.0
+                self.LoadRRMillisec(asciiData,settings)
         else:
             if (self.data["Verbose"]==True):
                 print("   File contains beats instants in seconds")
@@ -140,12 +1472,19 @@ class DM:
         
         self.data["BeatTime"]=dataSec
          
-        
-        self.data["niHR"] = 60.0/(self.data["BeatTime"][1:]-self.data["BeatTime"][0:-1])
-        self.data["niHR"] = np.insert(self.data["niHR"],[0],self.data["niHR"][0])
-
-        self.data["RR"] = 1000.0*(self.data["BeatTime"][1:]-self.data["BeatTime"][0:-1])
-        self.data["RR"] = np.insert(self.data["RR"],[0],self.data["RR"][0])
+        # Computed by chunks into the final arrays to avoid full-size temporaries
+        niHR = np.empty(len(dataSec),dtype=self.storageType)
+        RR = np.empty(len(dataSec),dtype=self.storageType)
+        for start in range(1,len(dataSec),ChunkLength):
+            end = min(start+ChunkLength,len(dataSec))
+            intervals = dataSec[start:end]-dataSec[start-1:end-1]
+            niHR[start:end] = 60.0/intervals
+            RR[start:end] = intervals*1000.0
+        niHR[0] = niHR[1]
+        RR[0] = RR[1]
+
+        self.data["niHR"] = niHR
+        self.data["RR"] = RR
         
         if (self.data["Verbose"]):
             print("   BeatTime: "+str(len(self.data["BeatTime"]))+" points (max: "+str(self.data["BeatTime"][-1])+")")
@@ -157,13 +1496,56 @@ class DM:
         if (self.data["Verbose"]):
             print("   Parameters set to default values")
             
+    def LoadBeatStore(self,store,settings):
+        """Loads beats positions from a WFDBBeatStore
+        BeatTime, niHR and RR are not decoded until they are first used"""
+
+        def beats():
+            return store.GetBeats()
+
+        def nihr():
+            niHR = 60.0/np.diff(self.data["BeatTime"])
+            return np.insert(niHR,[0],niHR[0]).astype(self.storageType,copy=False)
+
+        def rr():
+            RR = 1000.0*np.diff(self.data["BeatTime"])
+            return np.insert(RR,[0],RR[0]).astype(self.storageType,copy=False)
+
+        self.beatStore=store
+        self.data["BeatTime"]=LazyValue(beats)
+        self.data["niHR"]=LazyValue(nihr)
+        self.data["RR"]=LazyValue(rr)
+
+        if (self.data["Verbose"]):
+            print("   BeatTime: "+str(len(store))+" points (max: "+str(store.lastBeat)+"), decoded on demand")
+
+        for k in settings.keys():
+            self.data[k]=float(settings[k])
+        if (self.data["Verbose"]):
+            print("   Parameters set to default values")
         
     def LoadRRMillisec(self,dataMSec,settings):
         """Loads a vector containing milliseconds"""
         
-        self.data["RR"]=np.array(dataMSec)
-        self.data["BeatTime"]=np.cumsum(self.data["RR"])/1000.0
-        self.data["niHR"]=60.0/(self.data["RR"]/1000.0)
+        RR = np.asarray(dataMSec,dtype=np.float64)
+
+        # Computed by chunks into the final arrays to avoid full-size temporaries,
+        # carrying the accumulated time from one chunk to the next
+        BeatTime = np.empty(len(RR))
+        niHR = np.empty(len(RR),dtype=self.storageType)
+        accumulator = 0.0
+        for start in range(0,len(RR),ChunkLength):
+            chunk = BeatTime[start:start+ChunkLength]
+            chunk[:] = RR[start:start+ChunkLength]
+            chunk[0] += accumulator
+            np.cumsum(chunk,out=chunk)
+            accumulator = chunk[-1]
+            chunk /= 1000.0
+            niHR[start:start+ChunkLength] = 60.0/(RR[start:start+ChunkLength]/1000.0)
+
+        self.data["RR"]=RR.astype(self.storageType,copy=False)
+        self.data["BeatTime"]=BeatTime
+        self.data["niHR"]=niHR
         
         if (self.data["Verbose"]==True):
             print("   BeatTime: "+str(len(self.data["BeatTime"]))+" points (max: "+str(self.data["BeatTime"][-1])+")")
@@ -183,17 +1565,7 @@ class DM:
         if (self.data["Verbose"]==True):
             print("** Loading polar file "+polarFile)
         
-        dataMillisec=[]
-        dataFound=False
-        File = open(polarFile,'r')
-        for line in File:
-            if dataFound:
-                data=line.strip()
-                if data:
-                    dataMillisec.append(float(data))
-            if line.strip() == "[HRData]":
-                dataFound=True
-        File.close()
+        dataMillisec=ReadSectionColumn(polarFile,"HRData")
         
         self.LoadRRMillisec(dataMillisec,settings)
             
@@ -211,17 +1583,7 @@ class DM:
         if (self.data["Verbose"]==True):
             print("** Loading suunto file "+suuntoFile)
         
-        dataMillisec=[]
-        dataFound=False
-        File = open(suuntoFile,'r')
-        for line in File:
-            if dataFound:
-                data=line.strip()
-                if data:
-                    dataMillisec.append(float(data))
-            if line.strip() == "[CUSTOM1]":
-                dataFound=True
-        File.close()
+        dataMillisec=ReadSectionColumn(suuntoFile,"CUSTOM1")
         
         self.LoadRRMillisec(dataMillisec,settings)
         
@@ -232,8 +1594,10 @@ class DM:
             
         self.data["version"]=Version
 
-    def LoadBeatWFDB(self,wfdbheaderfile,settings):
-        """Loads wfdb file"""
+    def LoadBeatWFDB(self,wfdbheaderfile,settings,interactive=True):
+        """Loads wfdb file
+        interactive -> if False, errors raise IOError instead of showing a window,
+                       and the preferred annotator is used without asking"""
 
         import glob
         
@@ -264,6 +1628,8 @@ class DM:
         extensionsfound.remove('hea')
 
         if len(extensionsfound)==0:
+            if not interactive:
+                raise IOError("No data file found with: "+wfdbheaderfile)
             Utils.ErrorWindow(messageStr="No data file found with: "+wfdbheaderfile,captionStr="Error loading beats    ")
             return
 
@@ -277,7 +1643,7 @@ class DM:
             extensionsfound.remove('qrs')
             extensionsfound.insert(0,'qrs')
 
-        if len(extensionsfound)>1:
+        if len(extensionsfound)>1 and interactive:
             AnnotatorSelection=Utils.SelectAnnotator(extensionsfound)
             extensionSelected = AnnotatorSelection.GetValue()
             if extensionSelected == '':
@@ -296,57 +1662,19 @@ class DM:
 
         try:
 
-            datafile = open(wfdbdatafile,'rb')
-            accumulator=0.0
-            beats=[]
-
-            while True:
-                value = ord(datafile.read(1))+ord(datafile.read(1))*256
-                code = value >> 10
-                time = value % 1024
-                
-                # print ("Value: "+str(int(value)))
-                # print ("Code: "+str(code))
-                # print ("Time: "+str(time))
-
-                if code==0 and time==0:
-                    break
-
-                # Original code:
-                # if code==1: # Only normal beats
-
-                # Modified code:
-                if code<50: 
-                    accumulator = accumulator+time
-                    # print "Sec: ",accumulator/samplingFrequency
-                    beats.append(accumulator/samplingFrequency)
-                else:
-                    if code==63:
-                        # Modified code:
-                        jump = int(time) + int(time)%2
-                        x = datafile.read(jump)
-                        value = ord(datafile.read(1))+ord(datafile.read(1))*256
-                        # Original code:    
-                        # jump = int(time)/2 + int(time)%2
-                        # for i in range(jump):
-                        #     value = ord(datafile.read(1))+ord(datafile.read(1))*256
-                    else:
-                        if code==59 and time==0:
-                            for i in range(2):
-                                value = ord(datafile.read(1))+ord(datafile.read(1))*256
-                        else:
-                            if code!=60 and code!=61 and code!=62 and code!=22 and code!=0:
-                                accumulator = accumulator+time
+            store = WFDBBeatStore(wfdbdatafile,samplingFrequency)
         except:
             if (self.data["Verbose"]==True):
                 print("   File "+wfdbdatafile+" didn't work")
+            if not interactive:
+                raise IOError("Error loading file: "+wfdbdatafile)
             Utils.ErrorWindow(messageStr="Error loading file: "+wfdbdatafile,captionStr="Error loading beats    ")
             return
         else:
             if (self.data["Verbose"]==True):
                 print("   File "+wfdbdatafile+" has been loaded")
 
-        self.LoadBeatSec(np.array(beats),settings)
+        self.LoadBeatStore(store,settings)
         
         self.data["name"]=os.path.splitext(os.path.basename(wfdbheaderfile))[0]
         
@@ -383,6 +1711,7 @@ class DM:
                 self.data["EpisodesInitTime"].append(float(HMS[0])*3600.0+float(HMS[1])*60.0+float(HMS[2]))
             index += 1
         epFile.close()
+        self.__EpisodesModified()
                 
         self.data["EpisodesVisible"]=list(set(self.data["EpisodesType"]))
                 
@@ -452,86 +1781,20 @@ class DM:
             ApneaTag="Apnea"
 
             datafile = open(wfdbdatafile,'rb')
-
-            accumulator=0.0
-            ActiveTags=[]
-            ActiveTagsOnsets=[]
-            EpisodesTypes=[]
-            EpisodesInits=[]
-            EpisodesEnds=[]
+            data = datafile.read()
+            datafile.close()
 
             if extensionSelected=="apn":
-                while True:
-                    value = ord(datafile.read(1))+ord(datafile.read(1))*256
-                    code = value >> 10
-                    time = value % 1024
-
-                    if code==0 and time==0:
-                        break
-
-                    if code==8 and ApneaTag not in ActiveTags:
-                        ActiveTags.append(ApneaTag)
-                        ActiveTagsOnsets.append(accumulator)
-
-                    if code==1 and ApneaTag in ActiveTags:
-                        EpisodesTypes.append(ApneaTag)
-                        EpisodesInits.append(ActiveTagsOnsets[0])
-                        EpisodesEnds.append(accumulator)
-                        del ActiveTags[0]
-                        del ActiveTagsOnsets[0]
-
-                    if code == 59:
-                        interval = (ord(datafile.read(1))+ord(datafile.read(1))*256)*65536+(ord(datafile.read(1))+ord(datafile.read(1))*256)
-                        accumulator=accumulator+interval/samplingFrequency
-                        next
-
+                EpisodesTypes,EpisodesInits,EpisodesEnds,ActiveTags,ActiveTagsOnsets = DecodeWFDBEpisodes(data,samplingFrequency,ApneaTag)
             else:
-                while True:
-                    value = ord(datafile.read(1))+ord(datafile.read(1))*256
-                    code = value >> 10
-                    time = value % 1024
-                    
-                    if code==0 and time==0:
-                        break
-
-                    if code <= 49:
-                        next
-
-                    if code == 59:
-                        interval = (ord(datafile.read(1))+ord(datafile.read(1))*256)*65536+(ord(datafile.read(1))+ord(datafile.read(1))*256)
-                        accumulator=accumulator+interval/samplingFrequency
-                        next
-
-                    if code==22:
-                        ll = ord(datafile.read(1))
-                        datafile.read(1)  # value 252
-                        comment = datafile.read(ll)
-                        # print "  String: ",comment
-                        Tags=comment.split()
-
-                        if (ll%2):
-                            datafile.read(1)
-
-                        for ActiveTag in ActiveTags:
-                            if ActiveTag not in Tags:
-                                ii=ActiveTags.index(ActiveTag)
-                                EpisodesTypes.append(ActiveTag)
-                                EpisodesInits.append(ActiveTagsOnsets[ii])
-                                EpisodesEnds.append(accumulator)
-                                del ActiveTags[ii]
-                                del ActiveTagsOnsets[ii]
-
-                        for Tag in Tags:
-                            if Tag not in ActiveTags:
-                                ActiveTags.append(Tag)
-                                ActiveTagsOnsets.append(accumulator)
-
-
-            for ActiveTag in ActiveTags:
-                ii=ActiveTags.index(ActiveTag)
-                EpisodesTypes.append(ActiveTag)
+                EpisodesTypes,EpisodesInits,EpisodesEnds,ActiveTags,ActiveTagsOnsets = DecodeWFDBEpisodes(data,samplingFrequency)
+
+            if ActiveTags:
+                LastBeat = self.GetHRLimits()[1]
+            for ii in range(len(ActiveTags)):
+                EpisodesTypes.append(ActiveTags[ii])
                 EpisodesInits.append(ActiveTagsOnsets[ii])
-                EpisodesEnds.append(self.GetHRDataPlot()[0][-1]) # Last beat
+                EpisodesEnds.append(LastBeat)
 
         except:
             if (self.data["Verbose"]==True):
@@ -570,37 +1833,60 @@ class DM:
         Utils.InformEpisodesFile(wfdbdatafile,numAddedEpisodes)
 
                     
-    def LoadProject(self,datamodelFile):
-        """Loads the data model from a zip file"""
-        import zipfile, tempfile, shutil
-        tempDir = tempfile.mkdtemp(prefix="gHRV")
+    def LoadProject(self,datamodelFile,memoryMap=False):
+        """Loads the data model from a zip file
+        Members are read in memory, without temporary files. Arrays are not
+        decoded until they are first used; .npy members can also be memory-mapped
+        from the project file when they are stored uncompressed (the spectrogram
+        of the frames is always memory-mapped)"""
+        import zipfile, ast
         if self.data["Verbose"]:
             print("** Loading project: "+datamodelFile)
-            print("   Temporal directory: "+tempDir)
                 
         zf = zipfile.ZipFile(datamodelFile, mode='r')
+
+        projectFormat = 1
     
-        for zfitem in zf.namelist():
-            zf.extract(zfitem,tempDir)
-            fileName=tempDir+os.sep+zfitem
-            dataName=zfitem[1:]
-            # print("--- Reading file: "+fileName)
-            if zfitem[0]=="#":
-                self.data[dataName]=np.loadtxt(fileName)
-                # print("   Length: "+str(len(self.data[dataName])))
+        # Members are read in order, so the ones appended by incremental saves
+        # supersede older ones, and "-" members remove entries
+        for zfinfo in zf.infolist():
+            zfitem=zfinfo.filename
+            if zfitem=="%ProjectFormat":
+                projectFormat = int(zf.read(zfinfo))
+            elif zfitem[0]=="-":
+                if zfitem[1:] in self.data:
+                    del self.data[zfitem[1:]]
+            elif zfitem[0]=="#":
+                if zfitem.endswith(".npy"):
+                    dataName=zfitem[1:-4]
+                else:
+                    dataName=zfitem[1:]
+                mapped=memoryMap or dataName=="Spectrogram"
+                self.data[dataName]=LazyValue(lambda member=zfitem,mapped=mapped: ReadZipArray(datamodelFile,member,mapped),
+                    os.path.abspath(datamodelFile))
             else:
-                tempF = open(fileName,'r')
-                if dataName=="name" or dataName=='PPActiveTagLeft' or dataName=='PPActiveTagRight':
-                    self.data[dataName]=tempF.read()
+                dataName=zfitem[1:]
+                if dataName=="name" or dataName=='PPActiveTagLeft' or dataName=='PPActiveTagRight' or dataName=="FrameBasedStamp":
+                    self.data[dataName]=zf.read(zfinfo)
                 else:
-                    self.data[dataName]=eval(tempF.read())
-                tempF.close()
+                    self.data[dataName]=ast.literal_eval(zf.read(zfinfo))
                 # print("   Data: "+str(self.data[dataName]))
         zf.close()
 
+        self.beatStore=None
+        self.hrView=None
+
+        # Changes made from now on (imports from old versions) are pending to save
+        if projectFormat==ProjectFormat:
+            self.savedStamps[os.path.abspath(datamodelFile)]=self.data.GetStamp()
+
+        if self.data["Verbose"]:
+            print("   Project format: "+str(projectFormat))
+
         if "version" in self.data.keys():
             self.data["version"] = str(self.data["version"])
             # version needs to be a string for comparison purposes
+        oldProject = "version" not in self.data.keys() or self.data["version"]<Version
         
         # print ("Keys: "+str(self.data.keys()))
         
@@ -619,9 +1905,6 @@ class DM:
             if self.data['Verbose']:
                 print("   Importing project from gHRV 0.18 or older")
             self.ClearBands()
-            if self.HasFrameBasedParams():
-                self.ClearFrameBasedParams()
-                self.CalculateFrameBasedParams(showProgress=True)
             self.data["version"]=Version
 
         if self.data["version"]<Version:
@@ -630,12 +1913,20 @@ class DM:
                 print("   Project build with gHRV version: *"+self.data["version"]+"*")
                 print("   Importing project from an old version of gHRV")
             self.ClearBands()
-            if self.HasFrameBasedParams():
-                self.ClearFrameBasedParams()
-                self.CalculateFrameBasedParams(showProgress=True)
             self.data["version"]=Version
-              
-        shutil.rmtree(tempDir)
+
+        # Frame-based parameters are only recalculated when their inputs or the
+        # engine changed, and then in background
+        if self.HasFrameBasedParams():
+            stamp=self.GetFrameBasedStamp()
+            if "FrameBasedStamp" not in self.data and not oldProject:
+                # Calculated by this version of gHRV before stamps were kept
+                self.data["FrameBasedStamp"]=stamp
+            elif self.data.get("FrameBasedStamp")!=stamp:
+                if self.data['Verbose']:
+                    print("   Frame-based parameters are outdated: recalculating in background")
+                self.ClearFrameBasedParams()
+                self.CalculateFrameBasedParamsInBackground()
         
             
     def GetSettings(self):
@@ -654,37 +1945,139 @@ class DM:
                 self.data[k]=settings[k]
    
                         
-    def SaveProject(self,datamodelFile):
-        """Saves the data model into a zip file"""
-        
-        import zipfile,shutil,tempfile
-        
-        tempDir = tempfile.mkdtemp(prefix="gHRV")
-        
+    def SaveProject(self,datamodelFile,incremental=False):
+        """Saves the data model into a zip file
+        Arrays are stored as uncompressed .npy members (so they can be memory-mapped),
+        the rest of values as compressed text.
+        With incremental, if the file was saved or loaded before, only arrays changed
+        since then are appended (the rest of values are small and always written).
+        The file is rewritten when superseded members take more space than live ones"""
         
         if self.data["Verbose"]:
             print("** Saving project: "+datamodelFile)
-            #print("   Temporal directory: "+tempDir)
-                            
-        for kData in self.data.keys():
-            if type(self.data[kData])==np.ndarray:
-                tempFName=tempDir+os.sep+"#"+str(kData)
-                np.savetxt(tempFName,self.data[kData])
+
+        datamodelFile=os.path.abspath(datamodelFile)
+        stamp=self.data.GetStamp()
+
+        if incremental and self.__CanAppendProject(datamodelFile):
+            changed,removed=self.data.GetModifiedSince(self.savedStamps[datamodelFile])
+            if self.data["Verbose"]:
+                print("   Incremental save: "+str(len(changed))+" changed, "+str(len(removed))+" removed")
+            WriteProjectMembers(datamodelFile,self.__ProjectMembers(changed,onlyArrays=True)+
+                self.__ProjectMembers(self.data.keys(),onlyText=True),removed,mode='a')
+        else:
+            # Arrays read or mapped from the file being overwritten must be read before
+            for kData in self.data.keys():
+                if not self.data.IsLoaded(kData) and self.data.GetSource(kData)!=datamodelFile:
+                    continue
+                if isinstance(self.data[kData],np.memmap) and self.data[kData].filename is not None:
+                    if os.path.abspath(self.data[kData].filename)==datamodelFile:
+                        self.data[kData]=np.array(self.data[kData])
+            stamp=self.data.GetStamp()
+            WriteProjectMembers(datamodelFile,[("%ProjectFormat",str(ProjectFormat),None)]+
+                self.__ProjectMembers(self.data.keys()))
+
+        self.savedStamps[datamodelFile]=stamp
+
+    def Autosave(self,autosaveFile):
+        """Saves changes incrementally into autosaveFile in a background thread
+        Text values are serialized at call time, and arrays in the thread. Arrays
+        not decoded yet are copied from their project file, and the rest of entries
+        not computed yet (lazy heart rate, frame-based parameters being calculated)
+        are left for a later autosave, so the caller never waits for them.
+        Nothing is done if there are no changes or the previous autosave is still
+        being written"""
+
+        import threading, zipfile, io
+
+        autosaveFile=os.path.abspath(autosaveFile)
+        if self.autosaveThread is not None and self.autosaveThread.is_alive():
+            return
+        stamp=self.data.GetStamp()
+        pending=[k for k in self.autosavePending.get(autosaveFile,[]) if k in self.data]
+        if self.savedStamps.get(autosaveFile)==stamp and not any(self.data.IsLoaded(k) for k in pending):
+            return
+
+        if self.__CanAppendProject(autosaveFile):
+            changed,removed=self.data.GetModifiedSince(self.savedStamps[autosaveFile])
+            changed=list(set(changed+pending))
+            mode='a'
+        else:
+            changed=self.data.keys()
+            removed=[]
+            mode='w'
+
+        arrays=[]
+        copied=[]
+        pending=[]
+        for kData in changed:
+            if self.data.IsLoaded(kData):
+                if isinstance(self.data[kData],np.ndarray):
+                    arrays.append((kData,self.data[kData]))
+            elif self.data.GetSource(kData) is not None:
+                copied.append((kData,self.data.GetSource(kData)))
+            else:
+                pending.append(kData)
+        texts=self.__ProjectMembers(self.data.keys(),onlyText=True)
+        self.autosavePending[autosaveFile]=pending
+        if mode=='a':
+            removed=removed+pending # Older values in the file are outdated
+
+        # The stamp belongs to the data saved now: if the data model is cleared
+        # meanwhile, it must not be recorded for the new data
+        savedStamps=self.savedStamps
+        verbose=self.data["Verbose"]
+
+        def write():
+            try:
+                members=[]
+                if mode=='w':
+                    members.append(("%ProjectFormat",str(ProjectFormat),None))
+                for kData,value in arrays:
+                    arrayBuffer=io.BytesIO()
+                    np.save(arrayBuffer,value)
+                    members.append(("#"+str(kData)+".npy",arrayBuffer.getvalue(),zipfile.ZIP_STORED))
+                for kData,source in copied:
+                    members.append(CopyProjectMember(source,kData))
+                WriteProjectMembers(autosaveFile,members+texts,removed,mode)
+            except:
+                # Next autosave will rewrite the whole file
+                savedStamps.pop(autosaveFile,None)
+                if verbose:
+                    print("   Error autosaving project: "+autosaveFile)
             else:
+                savedStamps[autosaveFile]=stamp
+
+        if self.data["Verbose"]:
+            print("** Autosaving project: "+autosaveFile)
+        self.autosaveThread=threading.Thread(target=write)
+        self.autosaveThread.daemon=True
+        self.autosaveThread.start()
+
+    def __CanAppendProject(self,datamodelFile):
+        """Checks if changes can be appended to a project file saved or loaded before"""
+        if datamodelFile not in self.savedStamps or not os.path.exists(datamodelFile):
+            return False
+        wasted,live=ProjectWastedBytes(datamodelFile)
+        return wasted<=live
+
+    def __ProjectMembers(self,keys,onlyArrays=False,onlyText=False):
+        """Serializes entries as (member name, data, compression) tuples
+        Arrays not decoded yet are considered arrays without decoding them"""
+
+        import zipfile, io
+
+        members=[]
+        for kData in keys:
+            isArray = not self.data.IsLoaded(kData) or isinstance(self.data[kData],np.ndarray)
+            if isArray and not onlyText:
+                arrayBuffer=io.BytesIO()
+                np.save(arrayBuffer,self.data.Peek(kData))
+                members.append(("#"+str(kData)+".npy",arrayBuffer.getvalue(),zipfile.ZIP_STORED))
+            elif not isArray and not onlyArrays:
                 # print kData, ": ", type(self.data[kData])
-                tempFName=tempDir+os.sep+"%"+str(kData)
-                tempF = open(tempFName,'w')
-                tempF.write(str(self.data[kData]))
-                tempF.close()
-                        
-        zf = zipfile.ZipFile(datamodelFile, mode='w',compression=zipfile.ZIP_DEFLATED)          
-        list = os.listdir(tempDir)
-        for file in list:
-            #print("File: "+str(file))
-            zf.write(tempDir+os.sep+file,str(file))
-        zf.close()
-        
-        shutil.rmtree(tempDir)
+                members.append(("%"+str(kData),str(self.data[kData]),None))
+        return members
         
     def SaveFrameBasedData(self,dataFile,listOfBands,SepChar,RHeader,CHeader):
             
@@ -745,6 +2138,7 @@ class DM:
     def ClearHR(self):
         """Purges interpolated HR from data model"""
         del self.data["HR"]
+        self.hrView=None
         del self.data["PlotHRXMin"]
         del self.data["PlotHRXMax"]
         if (self.data["Verbose"]):
@@ -752,11 +2146,9 @@ class DM:
             
     def ClearFrameBasedParams(self):
         """Purges power bands information from data model"""
-        del self.data["ULF"]
-        del self.data["VLF"]
-        del self.data["LF"]
-        del self.data["HF"]
-        del self.data["LFHF"]
+        for k in FrameBasedKeys+["FrameBasedStamp","Spectrogram","SpectrogramKey"]:
+            if k in self.data:
+                del self.data[k]
         if (self.data["Verbose"]):
             print("** Power bands removed from data model")
                         
@@ -780,6 +2172,13 @@ class DM:
         self.data["EpisodesDuration"].append(float(end)-float(init))
         if tag not in self.data["EpisodesVisible"]:
             self.data["EpisodesVisible"].append(tag)
+        self.__EpisodesModified()
+
+    def __EpisodesModified(self):
+        """Marks the episodes lists as changed after modifying them in place"""
+        for k in ["EpisodesType","EpisodesInitTime","EpisodesDuration","EpisodesVisible"]:
+            if k in self.data:
+                self.data.SetModified(k)
 
     def SetEpisodes(self,Episodes):
         if (self.data["Verbose"]):
@@ -798,6 +2197,7 @@ class DM:
             self.data["EpisodesType"].append(Ep[0])
             self.data["EpisodesInitTime"].append(Ep[1])
             self.data["EpisodesDuration"].append(Ep[3])
+        self.__EpisodesModified()
 
         # Removes tags label if all episodes of this label were removed
         self.data["EpisodesVisible"]=[Tag for Tag in EpVis if Tag in self.data["EpisodesType"]]
@@ -808,9 +2208,11 @@ class DM:
     def ReplaceHRVectors(self,xvector,yvector,rrvector):
         """After EditNIHR the beats (Time, niHR and RR) are replaced"""
         
-        self.data["BeatTime"]=xvector
-        self.data["niHR"]=yvector
-        self.data["RR"]=rrvector
+        self.data["BeatTime"]=np.asarray(xvector,dtype=np.float64)
+        self.data["niHR"]=np.asarray(yvector,dtype=self.storageType)
+        self.data["RR"]=np.asarray(rrvector,dtype=self.storageType)
+        if "CorrectedBeats" in self.data:
+            del self.data["CorrectedBeats"]
         if (self.data["Verbose"]):
             print("** HR vectors replaced")
             print("   BeatTime: "+str(len(self.data["BeatTime"]))+" points (max: "+str(self.data["BeatTime"][-1])+")")
@@ -818,58 +2220,127 @@ class DM:
             print("   RR: "+str(len(self.data["RR"]))+" points")
 
                                 
+    def FilterBeats(self,stages):
+        """Removes the beats rejected by a pipeline of filters
+            stages -> filter stages (see RangeFilter), each one applied to the beats
+                      kept by the previous ones
+        Stages only produce masks: beat arrays are compacted once at the end.
+        Returns the number of beats removed by every stage as (name, beats) pairs"""
+        keep,removed=self.__FilterMask(stages)
+
+        if not keep.all():
+            self.data["BeatTime"]=self.data["BeatTime"][keep]
+            self.data["niHR"]=self.data["niHR"][keep]
+            self.data["RR"]=self.data["RR"][keep]
+            if "CorrectedBeats" in self.data:
+                self.data["CorrectedBeats"]=self.data["CorrectedBeats"][keep]
+
+        return removed
+
+    def CorrectEctopicBeats(self,stages=None):
+        """Replaces the beats rejected by a pipeline of filters with interpolated beats
+            stages -> filter stages detecting ectopic beats (MedianFilter by default)
+        Times of rejected beats are interpolated between the accepted beats around them,
+        so BeatTime keeps increasing and its length; RR and niHR are recalculated for
+        them and the beat after. Beats before the first or after the last accepted beat
+        can't be interpolated and are kept unchanged.
+        Corrected beats are marked in CorrectedBeats. Returns the number of corrected beats"""
+        if stages is None:
+            stages=[MedianFilter()]
+
+        if (self.data["Verbose"]):
+            print ("** Correcting ectopic beats")
+
+        keep,removed=self.__FilterMask(stages)
+        accepted=np.flatnonzero(keep)
+        if len(accepted)<2:
+            return 0
+        rejected=np.flatnonzero(~keep)
+        rejected=rejected[(rejected>accepted[0]) & (rejected<accepted[-1])]
+
+        BeatTime=np.array(self.data["BeatTime"],dtype=np.float64)
+        BeatTime[rejected]=np.interp(rejected,accepted,BeatTime[accepted])
+
+        changed=np.union1d(rejected,rejected+1)
+        intervals=BeatTime[changed]-BeatTime[changed-1]
+        RR=np.array(self.data["RR"],dtype=np.float64)
+        RR[changed]=1000.0*intervals
+        niHR=np.array(self.data["niHR"],dtype=np.float64)
+        niHR[changed]=60.0/intervals
+
+        corrected=np.zeros(len(BeatTime),dtype=bool)
+        if "CorrectedBeats" in self.data:
+            corrected|=self.data["CorrectedBeats"]
+        corrected[rejected]=True
+
+        self.data["BeatTime"]=BeatTime
+        self.data["RR"]=RR.astype(self.storageType,copy=False)
+        self.data["niHR"]=niHR.astype(self.storageType,copy=False)
+        self.data["CorrectedBeats"]=corrected
+
+        if (self.data["Verbose"]):
+            print ("   Number of corrected beats: "+str(len(rejected)))
+
+        return len(rejected)
+
+    def __FilterMask(self,stages):
+        """Applies filter stages, each one to the beats kept by the previous ones
+        Returns the mask of kept beats and the beats removed by every stage"""
+        niHR=self.data["niHR"]
+        keep=np.ones(len(niHR),dtype=bool)
+        removed=[]
+
+        for stage in stages:
+            kept=np.flatnonzero(keep)
+            if len(kept)==len(niHR):
+                stageMask=stage.Mask(niHR)
+            else:
+                stageMask=stage.Mask(niHR[kept])
+            keep[kept[~stageMask]]=False
+            removed.append((stage.name,len(kept)-int(np.count_nonzero(stageMask))))
+            if (self.data["Verbose"]):
+                print ("   "+stage.name+" filter: "+str(removed[-1][1])+" beats removed")
+
+        return keep,removed
+
     def FilterNIHR(self,winlength=50,last=13,minbpm=24,maxbpm=198):
         """Removes outliers from non interpolated heart rate"""
         if (self.data["Verbose"]):
            print ("** Filtering non-interpolated heart rate")
            print ("   Number of original beats: "+str(len(self.data["niHR"])))
 
-        # threshold initialization
-        ulast=last
-        umean=1.5*ulast
-
-        index=1
-        while index<len(self.data["niHR"])-1:
-            v=self.data["niHR"][max(index-winlength,0):index]
-            M=np.mean(v)
-            if ( ( (100*abs((self.data["niHR"][index]-self.data["niHR"][index-1])/self.data["niHR"][index-1]) < ulast) |
-            (100*abs((self.data["niHR"][index]-self.data["niHR"][index+1])/self.data["niHR"][index+1]) < ulast) |
-            (100*abs((self.data["niHR"][index]-M)/M) < umean) )
-            & (self.data["niHR"][index] > minbpm) & (self.data["niHR"][index] < maxbpm)):
-                index += 1
-            else:
-                self.data["BeatTime"]=np.delete(self.data["BeatTime"],index)
-                self.data["niHR"]=np.delete(self.data["niHR"],index)
-                self.data["RR"]=np.delete(self.data["RR"],index)
+        self.FilterBeats([HeuristicFilter(winlength,last,minbpm,maxbpm)])
 
         if (self.data["Verbose"]):
             print ("   Number of filtered beats: "+str(len(self.data["BeatTime"])))
 
                             
-    def InterpolateNIHR(self):
-        "Interpolates instantaneous heart rate (linear method)"   
+    def InterpolateNIHR(self,method="linear",dtype=None,lazy=False):
+        """Interpolates instantaneous heart rate
+            method -> "linear", "cubic" (cubic spline) or "pchip" (monotone cubic)
+            dtype -> type of the interpolated heart rate (storageType by default)
+            lazy -> if True, the whole series is not computed until it is used;
+                    plots compute only the range shown (see GetHRDataPlot)"""
 
-        from scipy import interpolate
+        if dtype is None:
+            dtype=self.storageType
+        view=InterpolatedHR(self.data["BeatTime"],np.asarray(self.data["niHR"],dtype=np.float64),self.data["interpfreq"],method,dtype)
 
         if self.data["Verbose"]:
-            print ("** Interpolating instantaneous heart rate (method: linear interpolation)")
+            print ("** Interpolating instantaneous heart rate (method: "+view.methodNames[method]+")")
             print ("   Frequency: "+str(self.data["interpfreq"])+" Hz")
+            print ("   Original signal from: "+str(view.xmin)+" to "+str(view.xmax))
+            print ("   Interpolating from "+str(view.xmin)+" to "+str(view.xmax)+" seconds")
 
-        xmin=self.data["BeatTime"][0]
-        xmax=self.data["BeatTime"][-1]
-        step=1.0/self.data["interpfreq"]
-        
-        tck = interpolate.interp1d(self.data["BeatTime"],self.data["niHR"])
-        xnew = np.arange(xmin,xmax,step)
-
-        if self.data["Verbose"]:
-            print ("   Original signal from: "+str(self.data["BeatTime"][0])+" to "+str(self.data["BeatTime"][-1]))
-            print ("   Interpolating from "+str(xmin)+" to "+str(xmax)+" seconds")
-           
-        self.data["HR"] = tck(xnew)
+        if lazy:
+            self.data["HR"]=LazyValue(view.Materialize)
+            self.hrView=view
+        else:
+            self.data["HR"]=view.Materialize()
+            self.hrView=None
 
         if self.data["Verbose"]:
-            print ("   Obtained "+str(len(self.data["HR"]))+" points")
+            print ("   Obtained "+str(len(view))+" points")
 
 
     def GetNumFrames(self,interfreq,windowsize,windowshift):
@@ -879,32 +2350,137 @@ class DM:
         return numframes
         
                 
-    def CalculateFrameBasedParams(self, showProgress=False):
+    def CalculateFrameBasedParams(self, showProgress=False, progress=None, workers=None):
         """Calculates power per band
             size -> size of window (seconds)
-            shift -> displacement of window (seconds)"""
-
-        hammingfactor=1.586
+            shift -> displacement of window (seconds)
+            showProgress -> progress is shown in a wx.ProgressDialog
+            progress -> else, called as progress(done,total); returning False cancels
+            workers -> processes for the non-linear analysis (frameBasedWorkers by default)"""
 
+        stamp=self.GetFrameBasedStamp()
+        inputs=self.__FrameBasedInputs()
+        if showProgress:
+            progress=FrameProgressDialog()
+        try:
+            params=self.__FrameBasedParams(inputs,progress,workers)
+        finally:
+            if showProgress:
+                progress.Destroy()
+        if params is None:
+            if self.HasFrameBasedParams():
+                self.ClearFrameBasedParams()
+        else:
+            for k in FrameBasedKeys:
+                self.data[k]=params[k]
+            self.data["FrameBasedStamp"]=stamp
+            if self.keepSpectrogram:
+                key=self.__SpectraKey(inputs)
+                self.__KeepSpectrogram(key,self.__CachedSpectra(key))
+
+    def CalculateFrameBasedParamsInBackground(self):
+        """Calculates frame-based parameters in a background thread
+        Meanwhile, parameters are lazy entries: reading any of them waits for the results"""
+        import threading
+
+        inputs=self.__FrameBasedInputs()
+        stamp=self.GetFrameBasedStamp()
+        results={}
+
+        def Calculate():
+            try:
+                results.update(self.__FrameBasedParams(inputs))
+            except Exception:
+                pass # Calculated again when read, so errors are raised in the caller
+
+        def Loader(key):
+            thread.join()
+            if not results:
+                results.update(self.__FrameBasedParams(inputs))
+            return results[key]
+
+        thread=threading.Thread(target=Calculate)
+        thread.daemon=True
+        thread.start()
+        for k in FrameBasedKeys:
+            self.data[k]=LazyValue(lambda key=k: Loader(key))
+        self.data["FrameBasedStamp"]=stamp
+
+    def UpdateFrameBasedBands(self):
+        """Integrates again the cached spectra of the frames after a change of
+        band limits; the rest of frame-based parameters are kept
+        Returns False if the spectra of the current heart rate and frame settings
+        are not cached, so all the parameters must be calculated again"""
+        if not self.HasFrameBasedParams():
+            return False
+        inputs=self.__FrameBasedInputs()
+        key=self.__SpectraKey(inputs)
+        spectra=self.__CachedSpectra(key)
+        if spectra is None:
+            return False
+        powers=FrameBandPowers(spectra,inputs)
+        for k in powers.keys():
+            self.data[k]=np.array(powers[k],dtype=self.storageType)
+        self.data["FrameBasedStamp"]=self.GetFrameBasedStamp()
+        if self.keepSpectrogram:
+            self.__KeepSpectrogram(key,spectra)
+        if self.data["Verbose"]:
+            print("** Power bands integrated from cached spectra")
+        return True
+
+    def GetFrameBasedStamp(self):
+        """Identifies the frame-based parameters of the current data: version
+        of the engine and hash of the inputs (HR, beats and settings)"""
+        import hashlib
+        digest=hashlib.sha1()
+        digest.update(np.ascontiguousarray(self.data["HR"],dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(self.data["BeatTime"],dtype=np.float64).tobytes())
+        digest.update(repr([float(self.data[k]) for k in listofsettings if k!='name']+[frameFFTFastLength]))
+        return str(FrameBasedEngineVersion)+":"+digest.hexdigest()
+
+    def __FrameBasedInputs(self):
+        """Snapshot of the data used by the frame-based analysis"""
+        inputs={"HR":self.data["HR"],"BeatTime":self.data["BeatTime"]}
+        for k in listofsettings:
+            if k!='name':
+                inputs[k]=self.data[k]
+        return inputs
+
+    def __SpectraKey(self,inputs):
+        """Identifies the spectra of the frames: heart rate and frame settings"""
+        import hashlib
+        digest=hashlib.sha1(np.ascontiguousarray(inputs["HR"],dtype=np.float64).tobytes())
+        return (digest.hexdigest(),inputs["interpfreq"],inputs["windowsize"],inputs["windowshift"],frameFFTFastLength)
+
+    def __CachedSpectra(self,key):
+        """Spectra of the frames identified by key, from the spectrogram of the
+        project or from the cache; None if they are not available"""
+        if self.HasSpectrogram() and self.data["SpectrogramKey"]==key:
+            return self.data["Spectrogram"]
+        if self.spectraCache is not None and self.spectraCache[0]==key:
+            return self.spectraCache[1]
+        return None
+
+    def __KeepSpectrogram(self,key,spectra):
+        """Stores the spectra of the frames in the data model (saved with the project)
+        The float32 spectra of the cache are stored without copying them"""
+        if self.HasSpectrogram() and self.data["SpectrogramKey"]==key:
+            return
+        self.data["Spectrogram"]=np.asarray(spectra,dtype=np.float32)
+        self.data["SpectrogramKey"]=key
 
+    def __FrameSpectra(self, inputs):
+        """Spectra of the frames from a snapshot of inputs, cached
+        Returns the signal (msec.), the first sample of every frame and the spectra"""
 
-        def power(spec,freq,fmin,fmax):
-            band = [spec[i] for i in range(len(spec)) if freq[i] >= fmin and freq[i]<fmax]
-            powerinband = hammingfactor*np.sum(band)/(2*len(spec)**2)
-            return powerinband
-                                
-        if self.data["Verbose"]:
-            print("** Calculating power per band")
-            
-        signal=1000/(self.data["HR"]/60.0) # msec.
+        HR=np.asarray(inputs["HR"],dtype=np.float64)
+        signal=1000/(HR/60.0) # msec.
 
-        shiftsamp=self.data['windowshift']*self.data["interpfreq"]
-        sizesamp=self.data['windowsize']*self.data["interpfreq"]
+        shiftsamp=inputs['windowshift']*inputs["interpfreq"]
+        sizesamp=inputs['windowsize']*inputs["interpfreq"]
         
         numframes=int(((len(signal)-sizesamp)/shiftsamp)+1.0)
 
-        lenZeroPadding=2**int(np.ceil(np.log2(sizesamp)))-int(sizesamp)
-        
         if (numframes < minNumFrames):
             raise Utils.FewFramesException(numframes)
 
@@ -915,15 +2491,50 @@ class DM:
         
         hw=np.hamming(sizesamp2)
 
-        if numframes<=10:
-            showProgress = False
+        starts=(np.arange(numframes)*shiftsamp).astype(np.int64)
+        key=self.__SpectraKey(inputs)
+        spectra=self.__CachedSpectra(key)
+        if spectra is None:
+            spectra=FrameSpectra(signal,starts,int(sizesamp),FFTLength(sizesamp,frameFFTFastLength),hw)
+            # Half the memory; bands integrated again from float32 spectra agree to ~1e-8
+            self.spectraCache=(key,spectra.astype(np.float32))
+        return signal,starts,spectra
 
-        
-        if showProgress:
-            import wx
-            dlg = wx.ProgressDialog("Calculating parameters","Preparing data...",maximum = (numframes-1)//10,
-                style=wx.PD_CAN_ABORT | wx.PD_AUTO_HIDE | wx.PD_REMAINING_TIME | wx.PD_ESTIMATED_TIME)
-        
+    def __FrameBasedParams(self, inputs, progress=None, workers=None):
+        """Calculates frame-based parameters from a snapshot of inputs
+        Returns a dictionary of arrays, or None if cancelled through progress"""
+
+        if self.data["Verbose"]:
+            print("** Calculating power per band")
+            
+        HR=np.asarray(inputs["HR"],dtype=np.float64)
+        shiftsamp=inputs['windowshift']*inputs["interpfreq"]
+        sizesamp=inputs['windowsize']*inputs["interpfreq"]
+        signal,starts,spectra=self.__FrameSpectra(inputs)
+        numframes=len(starts)
+
+        BeatTime=np.asarray(inputs["BeatTime"],dtype=np.float64)
+        begtimes=np.arange(numframes)*inputs['windowshift']
+        endtimes=begtimes+inputs['windowsize'] # seconds
+        firstbeats=np.searchsorted(BeatTime,begtimes,side='left')
+        lastbeats=np.searchsorted(BeatTime,endtimes,side='right')
+
+        begframes=starts
+        endframes=np.minimum((starts+sizesamp).astype(np.int64),len(HR)) # samples
+        numsamples=endframes-begframes
+        reference=np.mean(HR) # Sums of deviations keep the variance accurate
+        deviations=HR-reference
+        sumHR=WindowSums(deviations,begframes,endframes)
+        sumHR2=WindowSums(deviations**2,begframes,endframes)
+
+        RRDiffs=np.diff(1000.0*np.diff(BeatTime))
+        numdiffs=np.maximum(lastbeats-firstbeats-2,0)
+        enddiffs=firstbeats+numdiffs
+        sumDiffs2=WindowSums(RRDiffs**2,firstbeats,enddiffs)
+        numDiffs50=WindowSums(np.abs(RRDiffs)>50,firstbeats,enddiffs)
+
+        if workers is None:
+            workers=frameBasedWorkers
         
         if self.data["Verbose"]:
             print("   Signal length: "+str(len(signal))+" samples")
@@ -931,117 +2542,21 @@ class DM:
             print("   Frame shift: "+str(shiftsamp)+" samples")
             print("   Number of frames: "+str(numframes))
             
-        self.data["ULF"]=[]
-        self.data["VLF"]=[]
-        self.data["LF"]=[]
-        self.data["HF"]=[]
-        self.data["LFHF"]=[]
-        self.data["Power"]=[]
-        self.data["Mean HR"]=[]
-        self.data["HR STD"]=[]
-        self.data["pNN50"]=[]
-        self.data["rMSSD"]=[]
-        self.data["ApEn"]=[]
-        self.data["FracDim"]=[]
-
-
-
-
-        KeepGoing = True
-             
-        indexframe = 0   
-        while indexframe<numframes and KeepGoing:
-            if showProgress:
-                if indexframe%10 == 0:
-                    KeepGoing = dlg.Update(indexframe//10, "Frame number: %s/%s" % (indexframe,numframes))[0]
-                    # print "Keep: "+str(KeepGoing)
-            begframe=int(indexframe*shiftsamp)
-            endframe=int(begframe+sizesamp) # samples
-            frame=signal[begframe:endframe]
-            if (len(frame)%2 != 0):
-                frame=np.append(frame,[0])
-            
-            begtime=indexframe*self.data['windowshift']
-            endtime=begtime+self.data['windowsize'] # seconds
-            
-            frame=frame-np.mean(frame)
-            frame=frame*hw
-            frame = np.append(frame,np.zeros(lenZeroPadding))
-            
-            # print("-----------------------")
-            # print("Frame "+str(indexframe))
-            # print("Frame power (time): "+str(hammingfactor*np.mean(frame*frame))+" ms^2")
-
-            spec_tmp=np.absolute(np.fft.fft(frame))**2
-            spec=spec_tmp[0:(len(spec_tmp)/2)] # Only positive half of spectrum
+        params=FrameBandPowers(spectra,inputs)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            params["Mean HR"]=reference+sumHR/numsamples
+            params["HR STD"]=np.sqrt(np.maximum(sumHR2-sumHR*sumHR/numsamples,0)/(numsamples-1))
+            params["pNN50"]=100.0*numDiffs50/numdiffs
+            params["rMSSD"]=np.sqrt(sumDiffs2/numdiffs)
 
-            freqs = np.linspace(start=0,stop=self.data["interpfreq"]/2,num=len(spec),endpoint=True)
-
-            
-            # print("Frame power (frequency): "+str(power(spec,freqs,0,self.data["interpfreq"]/2)))
-            
-            ulfpower=power(spec,freqs,self.data["ulfmin"],self.data["ulfmax"])
-            self.data["ULF"].append(ulfpower)
-            #print("ULF power: "+str(ulfpower))
-            
-            vlfpower=power(spec,freqs,self.data["vlfmin"],self.data["vlfmax"])
-            self.data["VLF"].append(vlfpower)
-            #print("VLF power: "+str(vlfpower))
-            
-            lfpower=power(spec,freqs,self.data["lfmin"],self.data["lfmax"])
-            self.data["LF"].append(lfpower)
-            #print("LF power: "+str(lfpower))
-            
-            hfpower=power(spec,freqs,self.data["hfmin"],self.data["hfmax"])
-            self.data["HF"].append(hfpower)
-            #print("HF: "+str(hfpower))
-            
-            totalpower=power(spec,freqs,0,self.data["interpfreq"]/2.0)
-            self.data["Power"].append(totalpower)
-            
-            #print("ULF+VLF+LF+HF power: "+str(ulfpower+vlfpower+lfpower+hfpower))
-            
-            self.data["LFHF"].append(lfpower/hfpower)
-            #print("LF/HF: "+str(lfpower/hfpower))
-            
-            frameHR = self.data["HR"][begframe:endframe]
-            self.data["Mean HR"].append(np.mean(frameHR))
-            self.data["HR STD"].append(np.std(frameHR,ddof=1))            
-            
-            BeatsFrame = [x for x in self.data["BeatTime"] if x>=begtime and x<=endtime]
-            frameRR = 1000.0*np.diff(BeatsFrame)
-            # print "Window has ",len(BeatsFrame), " beats"
-            # print "frameHR - ",len(frameHR)
-            # print "frameRR - ",len(frameRR)
-            RRDiffs=np.diff(frameRR)
-            RRDiffs50 = [x for x in np.abs(RRDiffs) if x>50]
-            self.data["pNN50"].append(100.0*len(RRDiffs50)/len(RRDiffs))
-            self.data["rMSSD"].append(np.sqrt(np.mean(RRDiffs**2)))
-
-            ApEn,FracDim=self.CalculateNonLinearAnalysis(BeatsFrame)
-            self.data["ApEn"].append(ApEn)
-            self.data["FracDim"].append(FracDim)
-
-            indexframe += 1
-                
-        if showProgress:
-            dlg.Destroy()
+        nonLinear=FrameNonLinearAnalysis(BeatTime,firstbeats,lastbeats,workers,progress)
+        if nonLinear is None:
+            return None
+        params["ApEn"],params["FracDim"]=nonLinear
 
-        if not KeepGoing:
-            self.ClearFrameBasedParams()
-        else:
-            self.data["ULF"]=np.array(self.data["ULF"])
-            self.data["VLF"]=np.array(self.data["VLF"])
-            self.data["LF"]=np.array(self.data["LF"])
-            self.data["HF"]=np.array(self.data["HF"])
-            self.data["LFHF"]=np.array(self.data["LFHF"])
-            self.data["Power"]=np.array(self.data["Power"])
-            self.data["Mean HR"]=np.array(self.data["Mean HR"])
-            self.data["HR STD"]=np.array(self.data["HR STD"])
-            self.data["pNN50"]=np.array(self.data["pNN50"])
-            self.data["rMSSD"]=np.array(self.data["rMSSD"])
-            self.data["ApEn"]=np.array(self.data["ApEn"])
-            self.data["FracDim"]=np.array(self.data["FracDim"])
+        for k in FrameBasedKeys:
+            params[k]=np.array(params[k],dtype=self.storageType)
+        return params
 
 
     def CalculateNonLinearAnalysis(self,Data=None, N=1000):
@@ -1170,18 +2685,83 @@ class DM:
         
                         
             
-    def GetHRDataPlot(self):
-        if self.HasInterpolatedHR():
-            xvector = np.linspace(self.data["BeatTime"][0], self.data["BeatTime"][-1], len(self.data["HR"]))
-            yvector = self.data["HR"]
-        else: 
-            xvector = self.data["BeatTime"]
-            yvector = self.data["niHR"]
-        return (xvector,yvector)
-
-
-    def GetHRBeatTimes(self):
-        return self.data["BeatTime"]
+    def GetHRDataPlot(self,tmin=None,tmax=None,maxPoints=None):
+        """Returns times and heart rate for plotting (interpolated, if available)
+            tmin, tmax -> if given, only samples of this range (plus the ones at its sides)
+            maxPoints -> if given, samples are decimated to about this number
+        With a lazy interpolated heart rate, only the samples returned are computed"""
+        if tmin is None and tmax is None and maxPoints is None:
+            if self.HasInterpolatedHR():
+                xvector = np.linspace(self.data["BeatTime"][0], self.data["BeatTime"][-1], len(self.data["HR"]))
+                yvector = self.data["HR"]
+            else: 
+                xvector = self.data["BeatTime"]
+                yvector = self.data["niHR"]
+            return (xvector,yvector)
+
+        xfirst,xlast=self.GetHRLimits()
+        if tmin is None:
+            tmin=xfirst
+        if tmax is None:
+            tmax=xlast
+        if self.hrView is not None and not self.data.IsLoaded("HR"):
+            return self.hrView.GetRange(tmin,tmax,maxPoints)
+        if self.HasLazyBeats():
+            # Two beats more at each side: one for the sample next to the range and
+            # one for its heart rate
+            beats=self.beatStore.GetBeats(tmin,tmax,sides=2)
+            niHR=(60.0/np.diff(beats)).astype(self.storageType,copy=False)
+            if len(beats)>0 and beats[0]==self.beatStore.firstBeat:
+                xvector,yvector=beats,np.insert(niHR,[0],niHR[:1])
+            else:
+                xvector,yvector=beats[1:],niHR
+            first=max(np.searchsorted(xvector,tmin,side='right')-1,0)
+            last=min(np.searchsorted(xvector,tmax,side='left')+1,len(xvector))
+            stride=1
+            while maxPoints is not None and (last-first)//stride>maxPoints:
+                stride*=2
+            return (xvector[first:last:stride],yvector[first:last:stride])
+
+        xvector,yvector=self.GetHRDataPlot()
+        first=max(np.searchsorted(xvector,tmin,side='right')-1,0)
+        last=min(np.searchsorted(xvector,tmax,side='left')+1,len(xvector))
+        stride=1
+        while maxPoints is not None and (last-first)//stride>maxPoints:
+            stride*=2
+        return (xvector[first:last:stride],yvector[first:last:stride])
+
+    def GetHRLimits(self):
+        """Returns the first and last times of the heart rate plot, without computing it"""
+        if self.HasLazyBeats():
+            return (self.beatStore.firstBeat,self.beatStore.lastBeat)
+        return (self.data["BeatTime"][0],self.data["BeatTime"][-1])
+
+    def GetHRValueLimits(self):
+        """Returns the minimum and maximum of the non interpolated heart rate"""
+        if self.HasLazyBeats():
+            return (60.0/self.beatStore.maxInterval,60.0/self.beatStore.minInterval)
+        return (np.min(self.data["niHR"]),np.max(self.data["niHR"]))
+
+    def HasLazyHR(self):
+        """Checks if the interpolated heart rate is only computed for the ranges plotted"""
+        return self.hrView is not None and self.HasInterpolatedHR() and not self.data.IsLoaded("HR")
+
+    def HasLazyBeats(self):
+        """Checks if beats of a WFDB file are only decoded for the ranges plotted"""
+        return self.beatStore is not None and not self.HasInterpolatedHR() and not self.data.IsLoaded("BeatTime")
+
+
+    def GetHRBeatTimes(self,tmin=None,tmax=None):
+        """Returns beats positions, optionally only those between tmin and tmax
+        Beats of WFDB files not decoded yet are decoded only for the requested range"""
+        if tmin is None and tmax is None:
+            return self.data["BeatTime"]
+        if self.beatStore is not None and not self.data.IsLoaded("BeatTime"):
+            return self.beatStore.GetBeats(tmin,tmax)
+        beats = self.data["BeatTime"]
+        first = 0 if tmin is None else np.searchsorted(beats,tmin,side='left')
+        last = len(beats) if tmax is None else np.searchsorted(beats,tmax,side='right')
+        return beats[first:last]
 
     def GetHR_RR(self):
         return self.data["RR"]
@@ -1557,6 +3137,43 @@ class DM:
         else:
             return(False)
             
+    def HasSpectrogram(self):
+        """Checks if the spectra of the frames are in the data model"""
+        return self.data.has_key("Spectrogram")
+
+    def SetKeepSpectrogram(self,keep):
+        """Keeps (or not) the spectrogram of the frames (float32) in the data model
+        and project file, so bands can be integrated again without recalculation"""
+        self.keepSpectrogram=keep
+        if not keep:
+            for k in ["Spectrogram","SpectrogramKey"]:
+                if k in self.data:
+                    del self.data[k]
+
+    def IsSpectrogramVisible(self):
+        """Checks if the spectrogram is shown in the frame-based plot"""
+        return self.HasSpectrogram() and self.data.has_key("SpectrogramVisible") and self.data["SpectrogramVisible"]
+
+    def SetSpectrogramVisible(self,visible):
+        """Shows (or hides) the spectrogram in the frame-based plot
+        Showing it keeps the spectrogram from then on; if it is not in the data model,
+        only the spectra of the frames are calculated (or taken from the cache)"""
+        self.data["SpectrogramVisible"]=visible
+        if visible:
+            self.keepSpectrogram=True
+            if self.HasFrameBasedParams() and not self.HasSpectrogram():
+                inputs=self.__FrameBasedInputs()
+                self.__KeepSpectrogram(self.__SpectraKey(inputs),self.__FrameSpectra(inputs)[2])
+
+    def GetSpectrogramPlot(self):
+        """Returns centers of frames (sec.), frequencies (Hz) and spectrogram (frames x
+        frequencies) up to the upper limit of the HF band"""
+        spectrogram=self.data["Spectrogram"]
+        freqs=np.linspace(start=0,stop=self.data["interpfreq"]/2,num=spectrogram.shape[1],endpoint=True)
+        numbins=max(2,np.searchsorted(freqs,self.data["hfmax"],side='right'))
+        times=np.arange(len(spectrogram))*self.data["windowshift"]+self.data["windowsize"]/2.0
+        return times,freqs[:numbins],spectrogram[:,:numbins]
+
     def GetEpisodes(self):
         """Gets all the information of the episodes for time plotting"""
         return(self.data["EpisodesType"],self.data["EpisodesInitTime"],self.data["EpisodesDuration"],self.data["EpisodesVisible"])
@@ -1601,6 +3218,7 @@ class DM:
         self.data["EpisodesType"] = [NewTag  if w == OldTag else w for w in self.data["EpisodesType"]]
         self.data["EpisodesVisible"] = [NewTag if w == OldTag else w for w in self.data["EpisodesVisible"] ]
         self.data["DictColors"][NewTag] = self.data["DictColors"].pop(OldTag)
+        self.data.SetModified("DictColors")
 
 
     def GetVisibleBands(self):
@@ -2124,9 +3742,9 @@ class DM:
                 ymin,ymax = HRaxes.get_ylim()
                 ypos = ymin+(ymax-ymin)*0.01
                 
-                xvector = self.GetHRDataPlot()[0]
-                xminrel = (self.data["PlotHRXMin"]-xvector[0])/(xvector[-1]-xvector[0])
-                xmaxrel = (self.data["PlotHRXMax"]-xvector[0])/(xvector[-1]-xvector[0])
+                xfirst,xlast = self.GetHRLimits()
+                xminrel = (self.data["PlotHRXMin"]-xfirst)/(xlast-xfirst)
+                xmaxrel = (self.data["PlotHRXMax"]-xfirst)/(xlast-xfirst)
                 if self.HRPosLinePresent:
                     self.fgHRPosLine.remove()
                     self.bgHRPosLine.remove()
@@ -2135,6 +3753,12 @@ class DM:
                 self.HRPosLinePresent=True
     
     
+            def drawHR():
+                # A lazy heart rate is only computed for the range shown
+                if lazyHR:
+                    HRline.set_data(*self.GetHRDataPlot(self.data["PlotHRXMin"],self.data["PlotHRXMax"],maxPoints))
+
+
             def zoomin(event):
                 if self.data["Verbose"]:
                     print("** HR Zoom in")
@@ -2142,6 +3766,7 @@ class DM:
                 self.data["PlotHRXMin"]+=delta
                 self.data["PlotHRXMax"]-=delta
                 HRaxes.set_xlim(self.data["PlotHRXMin"],self.data["PlotHRXMax"])
+                drawHR()
                 drawPosLine()
                 fig.canvas.draw()
     
@@ -2152,10 +3777,11 @@ class DM:
                 delta=(self.data["PlotHRXMax"]-self.data["PlotHRXMin"])*0.2
                 self.data["PlotHRXMin"]-=delta
                 self.data["PlotHRXMax"]+=delta
-                xvector = self.GetHRDataPlot()[0]
-                self.data["PlotHRXMin"]=max(xvector[0],self.data["PlotHRXMin"])
-                self.data["PlotHRXMax"]=min(xvector[-1],self.data["PlotHRXMax"])
+                xfirst,xlast = self.GetHRLimits()
+                self.data["PlotHRXMin"]=max(xfirst,self.data["PlotHRXMin"])
+                self.data["PlotHRXMax"]=min(xlast,self.data["PlotHRXMax"])
                 HRaxes.set_xlim(self.data["PlotHRXMin"],self.data["PlotHRXMax"])
+                drawHR()
                 drawPosLine()
                 fig.canvas.draw()
                 
@@ -2163,10 +3789,9 @@ class DM:
             def zoomreset(event):
                 if self.data["Verbose"]:
                     print("** HR Zoom reset")
-                xvector = self.GetHRDataPlot()[0]
-                self.data["PlotHRXMin"] = xvector[0]
-                self.data["PlotHRXMax"] = xvector[-1]
+                self.data["PlotHRXMin"],self.data["PlotHRXMax"] = self.GetHRLimits()
                 HRaxes.set_xlim(self.data["PlotHRXMin"],self.data["PlotHRXMax"])
+                drawHR()
                 drawPosLine()
                 fig.canvas.draw()
     
@@ -2175,11 +3800,11 @@ class DM:
                 if self.data["Verbose"]:
                     print("** HR Pan right")
                 delta=(self.data["PlotHRXMax"]-self.data["PlotHRXMin"])*0.1
-                xvector = self.GetHRDataPlot()[0]
-                delta=min(delta,xvector[-1]-self.data["PlotHRXMax"])
+                delta=min(delta,self.GetHRLimits()[1]-self.data["PlotHRXMax"])
                 self.data["PlotHRXMin"] += delta
                 self.data["PlotHRXMax"] += delta
                 HRaxes.set_xlim(self.data["PlotHRXMin"],self.data["PlotHRXMax"])
+                drawHR()
                 drawPosLine()
                 fig.canvas.draw()
     
@@ -2188,11 +3813,11 @@ class DM:
                 if self.data["Verbose"]:
                     print("** HR Pan left")
                 delta=(self.data["PlotHRXMax"]-self.data["PlotHRXMin"])*0.1
-                xvector = self.GetHRDataPlot()[0]
-                delta=min(delta,self.data["PlotHRXMin"]-xvector[0])
+                delta=min(delta,self.data["PlotHRXMin"]-self.GetHRLimits()[0])
                 self.data["PlotHRXMin"] -= delta
                 self.data["PlotHRXMax"] -= delta
                 HRaxes.set_xlim(self.data["PlotHRXMin"],self.data["PlotHRXMax"])
+                drawHR()
                 drawPosLine()
                 fig.canvas.draw()
     
@@ -2220,12 +3845,26 @@ class DM:
 
 
         
-        xvector, yvector = self.GetHRDataPlot()
         if "PlotHRXMin" not in self.data:
-            self.data["PlotHRXMin"]=xvector[0]
-            self.data["PlotHRXMax"]=xvector[-1]
-        
-        HRaxes.plot(xvector,yvector,'k-')
+            self.data["PlotHRXMin"],self.data["PlotHRXMax"]=self.GetHRLimits()
+
+        lazyHR = self.HasLazyHR() or self.HasLazyBeats()
+        if lazyHR:
+            # Only the range shown, with about two samples per pixel. Vertical limits
+            # are those of the whole series, as when all of it is plotted
+            maxPoints = int(2*fig.get_size_inches()[0]*fig.dpi)
+            if zoomReset:
+                xvector, yvector = self.GetHRDataPlot(maxPoints=maxPoints)
+            else:
+                xvector, yvector = self.GetHRDataPlot(self.data["PlotHRXMin"],self.data["PlotHRXMax"],maxPoints)
+            HRline, = HRaxes.plot(xvector,yvector,'k-')
+            xfirst,xlast = self.GetHRLimits()
+            yfirst,ylast = self.GetHRValueLimits()
+            HRaxes.update_datalim([(xfirst,yfirst),(xlast,ylast)])
+            HRaxes.autoscale_view()
+        else:
+            xvector, yvector = self.GetHRDataPlot()
+            HRaxes.plot(xvector,yvector,'k-')
         HRaxes.set_xlabel("Time (sec.)")
         HRaxes.set_ylabel("HR (beats/min.)")
         
@@ -2468,6 +4107,11 @@ class DM:
         xvectorframe=np.array([x*self.data["windowshift"]+self.data["windowsize"]/2.0 for x in range(len(ulfvector))])
         
         self.AllBands, self.VisibleBands=self.GetVisibleBands()
+
+        showSpectrogram=self.IsSpectrogramVisible()
+        numPlots=len(self.VisibleBands)
+        if showSpectrogram:
+            numPlots += 1 # On top of the bands
         
         hasEpisodes=self.HasVisibleEpisodes()
         if hasEpisodes:
@@ -2507,7 +4151,7 @@ class DM:
         FBaxesbands=[]
             
         # Heart rate plot
-        axBottom = fig.add_subplot(len(self.VisibleBands),1,len(self.VisibleBands))
+        axBottom = fig.add_subplot(numPlots,1,numPlots)
         CreateBandSupblot(axBottom, xvectortime, hrvector, 'Heart rate')
         axBottom.tick_params(axis='x',labelbottom='on')
         axBottom.set_xlabel('Time [sec.]',fontsize=10)
@@ -2527,7 +4171,7 @@ class DM:
         for Band in BandsToPlot:
             BandIndex = BandsToPlot.index(Band)
             
-            axBand=fig.add_subplot(len(self.VisibleBands),1,BandIndex+1)
+            axBand=fig.add_subplot(numPlots,1,numPlots-len(BandsToPlot)+BandIndex)
             if Band == "LF/HF":
                 CreateBandSupblot(axBand, xvectorframe, lfhfvector, 'LF/HF')
             if Band == "ULF":
@@ -2557,6 +4201,19 @@ class DM:
                 AddEpisodesToBandSubplot(axBand)
                 
             FBaxesbands.append(axBand)
+
+        if showSpectrogram:
+            axSpectrogram=fig.add_subplot(numPlots,1,1)
+            spectrogramtimes,spectrogramfreqs,spectrogram=self.GetSpectrogramPlot()
+            halfshift=self.data["windowshift"]/2.0
+            axSpectrogram.imshow(10*np.log10(np.asarray(spectrogram,dtype=np.float64).T+1e-12),
+                origin='lower',aspect='auto',interpolation='nearest',cmap='jet',
+                extent=(spectrogramtimes[0]-halfshift,spectrogramtimes[-1]+halfshift,spectrogramfreqs[0],spectrogramfreqs[-1]))
+            axSpectrogram.set_ylabel('Freq. [Hz]')
+            axSpectrogram.tick_params(axis='x',labelbottom='off')
+            axSpectrogram.set_xlim(xvectortimemin,xvectortimemax)
+            axSpectrogram.yaxis.set_major_locator(matplotlib.pyplot.MaxNLocator(4))
+            FBaxesbands.append(axSpectrogram)
         
         if not zoomReset:        
             for axes in FBaxesbands:
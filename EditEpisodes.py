@@ -601,7 +601,7 @@ class ManualEditionWindow(wx.Frame):
                 ErrorMsg = "Limits of episode are inverted"
 
         if not ErrorMsg:
-            if values["EndTime"]>self.dm.GetHRDataPlot()[0][-1]:
+            if values["EndTime"]>self.dm.GetHRLimits()[1]:
                 ErrorMsg = "Limits of episode are beyond the HR signal"
 
         if ErrorMsg:
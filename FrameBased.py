@@ -149,6 +149,10 @@ class FrameBasedEvolutionWindow(wx.Frame):
             self.bandsRB.append(tmp)
             sbBandsSizer.Add(tmp, wx.EXPAND)
         
+        self.spectrogramCB = wx.CheckBox(self.panel, label="Spectrogram")
+        self.spectrogramCB.SetValue(self.dm.IsSpectrogramVisible())
+        sbBandsSizer.Add(self.spectrogramCB, wx.EXPAND)
+        
         self.vboxRightArea.Insert(0,sbBandsSizer, flag=wx.ALL, border=borderSmall)
         
     def onRefresh(self,event):
@@ -161,12 +165,15 @@ class FrameBasedEvolutionWindow(wx.Frame):
             #print "Band: ",bandname,"  - Checked: ",bandstatus
         
         self.dm.SetVisibleBands(checkedBands)
+        self.dm.SetSpectrogramVisible(self.spectrogramCB.GetValue())
         
         self.dm.CreatePlotFBEmbedded(self.fig)
         self.canvas.draw()
 
 
     def Refresh(self):
+        # Parameters calculated again may come without spectrogram
+        self.dm.SetSpectrogramVisible(self.spectrogramCB.GetValue())
         self.dm.CreatePlotFBEmbedded(self.fig)
         self.canvas.draw()
 
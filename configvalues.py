@@ -31,6 +31,8 @@ ReportVersion = False
 ColoredButtons = True
 ColoredBGPlots = True
 Version="1.91" # Things like 1.0.5 are not valid. This is string (1.10 < 1.9)
+ProjectFormat=2 # 1: arrays as text, 2: arrays as .npy
+FrameBasedEngineVersion=2 # Increase when frame-based results change
 
 borderBig=10
 borderSmall=5
@@ -114,6 +116,13 @@ textCtrlSize=(60,25)
 textCtrlSizeBig=(80,25)
 
 minNumFrames = 3
+frameFFTFastLength = False # Pad frames to a fast FFT length instead of the next power of 2 (powers keep their scale, but band limits fall on a different frequency grid, so narrow bands may change)
+frameBasedWorkers = 1 # Processes for the non-linear analysis of frames (0: one per cpu)
+frameSpectrogram = False # Keep the spectra of the frames (float32) in the project, so bands are integrated again without recalculation (turned on when the spectrogram is shown in the frame-based window)
+
+autosaveInterval = 60 # seconds
+
+storagePrecision = "float64" # "float32" halves memory of heart rate and frame-based arrays (BeatTime is always float64)
 
 verticalFactorPBPlot=0.9
 
@@ -53,7 +53,7 @@ import os
 import numpy as np
 from sys import platform
 
-from DataModel import DM
+from DataModel import DM, listofbandsettings
 from configvalues import *
 from AboutDlg import AboutDlg
 from FrameBased import *
@@ -81,6 +81,7 @@ class MainWindow(wx.Frame):
 
     configDir = os.path.expanduser('~')+os.sep+'.ghrv'
     configFile = configDir+os.sep+"ghrv.cfg"
+    autosaveFile = configDir+os.sep+"autosave.ghrv"
     sbDefaultText="  gHRV %s - http://ghrv.milegroup.net" % Version
         
     def __init__(self, parent, id, title):
@@ -96,6 +97,10 @@ class MainWindow(wx.Frame):
             self.SetIcon(icon)
                 
         self.Bind(wx.EVT_CLOSE,self.OnExit)
+
+        self.autosaveTimer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnAutosave, self.autosaveTimer)
+        self.autosaveTimer.Start(autosaveInterval*1000)
          
         self.MainPanel=wx.Panel(self)
         self.fbWindowPresent=False
@@ -824,7 +829,7 @@ class MainWindow(wx.Frame):
                 EpDur = dm.GetEpisodes()[2]
                 EpFin = [float(EpInit[x])+float(EpDur[x]) for x in range(len(EpInit))]
                 EpFinMax = max(EpFin)
-                if EpFinMax > dm.GetHRDataPlot()[0][-1]:
+                if EpFinMax > dm.GetHRLimits()[1]:
                     self.WarningWindow(messageStr="WARNING: one or more episodes are outside of time axis",captionStr="Episodes warning")
 
         self.canvas.SetFocus()
@@ -859,7 +864,7 @@ class MainWindow(wx.Frame):
         if result == wx.ID_OK:
             fileName=dial.GetPath()
             try:
-                dm.SaveProject(str(unicode(fileName)))
+                dm.SaveProject(str(unicode(fileName)),incremental=True)
                 Utils.InformCorrectFile(fileName)
             except UnicodeEncodeError:
                     Utils.ErrorWindow(messageStr="Ilegal characters in filename: "+fileName,
@@ -927,7 +932,7 @@ class MainWindow(wx.Frame):
         self.buttonExportHR.Enable()
         
     def OnInterpolateNIHR(self,event):
-        dm.InterpolateNIHR()
+        dm.InterpolateNIHR(lazy=True)
         self.RefreshMainWindow()
         
 
@@ -971,8 +976,14 @@ class MainWindow(wx.Frame):
         result = dial.ShowModal()
         dial.Destroy()
         if result == wx.ID_YES:
+            self.autosaveTimer.Stop()
             self.Destroy()
 
+    def OnAutosave(self, event):
+        """Saves changes of the current project in the autosave file"""
+        if dm.HasHR():
+            dm.Autosave(self.autosaveFile)
+
     def Abort(self):
         self.Destroy()
         
@@ -1026,6 +1037,12 @@ class MainWindow(wx.Frame):
                 if self.projectSettings[k] != self.oldProjectSettings[k]:
                     onlyNameChanges = False
         
+        onlyBandsChange = True
+        for k in self.projectSettings.keys():
+            if k != 'name' and k not in listofbandsettings:
+                if self.projectSettings[k] != self.oldProjectSettings[k]:
+                    onlyBandsChange = False
+        
         dial = wx.MessageDialog(self, "Applying new settings to project\nThis may change some results\nAre you sure?", "Confirm applying", wx.YES_NO | wx.NO_DEFAULT | wx.ICON_QUESTION)
         result = dial.ShowModal()
         dial.Destroy()
@@ -1035,16 +1052,17 @@ class MainWindow(wx.Frame):
         dm.SetSettings(self.projectSettings)
         
         if dm.HasInterpolatedHR():
-            if not onlyNameChanges:
+            if not onlyBandsChange:
                 dm.ClearHR()
-                dm.InterpolateNIHR()
+                dm.InterpolateNIHR(lazy=True)
         
         self.RefreshMainWindowPlot()
             
         if dm.HasFrameBasedParams():
             if not onlyNameChanges:
-                dm.ClearFrameBasedParams()
-                dm.CalculateFrameBasedParams(showProgress=True)
+                if not (onlyBandsChange and dm.UpdateFrameBasedBands()):
+                    dm.ClearFrameBasedParams()
+                    dm.CalculateFrameBasedParams(showProgress=True)
             if self.fbWindowPresent:
                 self.fbWindow.Refresh()
     